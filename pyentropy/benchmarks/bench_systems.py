@@ -0,0 +1,224 @@
+#    This file is part of pyEntropy
+#
+#    pyEntropy is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 2 of the License, or
+#    (at your option) any later version.
+#
+#    pyEntropy is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with pyEntropy. If not, see <http://www.gnu.org/licenses/>.
+#
+#    Copyright 2009, 2010 Robin Ince
+"""
+Benchmarks of DiscreteSystem and SortedDiscreteSystem.
+
+Measures the wall time and peak memory of ``calculate_entropies`` over a
+grid of number of trials (N), word length (X_n), alphabet size (X_m),
+output space size (Y_dim), calc sets and correction methods, for both
+system classes. Usage::
+
+    python benchmarks/bench_systems.py [options]
+
+    -o FILE       write results (JSON) to FILE
+    -b FILE       compare against baseline results FILE
+    --tol T       allowed relative slowdown / memory growth (default 0.25)
+    --full        full product of the grid (default: vary one parameter
+                  at a time around a reference case)
+    --quick       small grid for a fast check
+    -r R          repeats per case, the fastest is reported (default 3)
+
+Each case runs in a fresh interpreter, so peak memory (``ru_maxrss``) is
+not affected by earlier cases. Both the peak resident size of the process
+and the growth of the peak during ``calculate_entropies`` are recorded.
+When a baseline is given the script exits with status 1 if any case is
+slower (or uses more memory) than the baseline by more than the tolerance.
+To check a release, store results of the previous release on the same 
+machine (``-o baseline.json``) and compare with ``-b baseline.json``.
+
+"""
+
+import sys
+import os
+import time
+import json
+import resource
+import subprocess
+from optparse import OptionParser, SUPPRESS_HELP
+
+import numpy as np
+
+# use the pyentropy of this checkout
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+# reference case and values varied one at a time
+REFERENCE = dict(system='DiscreteSystem', N=100000, X_n=4, X_m=3, Y_dim=8,
+                 calc='I', method='plugin')
+GRID = dict(system=['DiscreteSystem', 'SortedDiscreteSystem'],
+            N=[10000, 100000, 1000000],
+            X_n=[2, 4, 8],
+            X_m=[2, 3, 4],
+            Y_dim=[2, 8, 64],
+            calc=['I', 'Ish', 'Ishush', 'Pola'],
+            method=['plugin', 'pt', 'qe', 'nsb'])
+QUICK = dict(system=['DiscreteSystem', 'SortedDiscreteSystem'],
+             N=[10000],
+             X_n=[4],
+             X_m=[3],
+             Y_dim=[8],
+             calc=['I', 'Ish'],
+             method=['plugin', 'pt', 'qe', 'nsb'])
+# entropies needed for each information quantity
+CALC = {'I': ['HX', 'HXY'],
+        'Ish': ['HX', 'HiXY', 'HshXY', 'HXY'],
+        'Ishush': ['HX', 'SiHXi', 'HshX', 'HiXY', 'HshXY', 'HXY'],
+        'Pola': ['HX', 'HXY', 'SiHXi', 'HiXY', 'HiX', 'ChiX', 'HshXY']}
+KEYS = ['system', 'N', 'X_n', 'X_m', 'Y_dim', 'calc', 'method']
+
+
+def cases(grid, full=False):
+    """List of case dicts of the grid"""
+    if full:
+        out = [{}]
+        for k in KEYS:
+            out = [dict(c, **{k: v}) for c in out for v in grid[k]]
+        return out
+    out = []
+    for k in KEYS:
+        for v in grid[k]:
+            c = dict(REFERENCE, **{k: v})
+            for kk in KEYS:
+                # reference values outside a reduced grid
+                if c[kk] not in grid[kk]:
+                    c[kk] = grid[kk][0]
+            if c not in out:
+                out.append(c)
+    return out
+
+
+def case_key(case):
+    return ' '.join(['%s=%s' % (k, case[k]) for k in KEYS])
+
+
+def _maxrss():
+    """Peak resident set size of this process in bytes"""
+    r = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on OS X
+    return r if sys.platform == 'darwin' else r * 1024
+
+
+def run_case(case, repeats):
+    """Time calculate_entropies for a case (in this process)"""
+    from pyentropy import DiscreteSystem, SortedDiscreteSystem
+    rs = np.random.RandomState(0)
+    N = case['N']
+    X = rs.randint(0, case['X_m'], (case['X_n'], N))
+    Y = rs.randint(0, case['Y_dim'], N)
+    calc = CALC[case['calc']]
+    if case['system'] == 'SortedDiscreteSystem':
+        order = np.argsort(Y, kind='mergesort')
+        Ny = np.bincount(Y, minlength=case['Y_dim'])
+        args = (X[:,order], (case['X_n'], case['X_m']), case['Y_dim'], Ny)
+        make = lambda: SortedDiscreteSystem(*args)
+    else:
+        args = (X, (case['X_n'], case['X_m']), Y[np.newaxis,:],
+                (1, case['Y_dim']))
+        make = lambda: DiscreteSystem(*args)
+    rss0 = _maxrss()
+    times = []
+    for r in xrange(repeats):
+        s = make()
+        t0 = time.time()
+        s.calculate_entropies(method=case['method'], calc=calc)
+        times.append(time.time() - t0)
+        del s
+    rss1 = _maxrss()
+    return dict(case, time=min(times), peak_rss=rss1,
+                peak_growth=rss1 - rss0)
+
+
+def run(grid, full, repeats):
+    """Run each case of the grid in a fresh interpreter"""
+    results = []
+    for case in cases(grid, full):
+        p = subprocess.Popen([sys.executable, os.path.abspath(__file__),
+                              '--case', json.dumps(case),
+                              '-r', str(repeats)],
+                             stdout=subprocess.PIPE)
+        out = p.communicate()[0]
+        if p.returncode != 0:
+            print "FAILED   %s" % case_key(case)
+            continue
+        res = json.loads(out)
+        print "%8.4fs %7.1fMB  %s" % (res['time'],
+            res['peak_growth'] / 2.0**20, case_key(case))
+        results.append(res)
+    return results
+
+
+def compare(results, baseline, tol):
+    """Compare results to baseline results. Returns list of regressions"""
+    base = dict([(case_key(b), b) for b in baseline])
+    bad = []
+    print "\n%8s %8s  case" % ('time', 'memory')
+    for r in results:
+        b = base.get(case_key(r))
+        if b is None:
+            continue
+        # times below 10ms and memory growth below a few MB are noise
+        tr = max(r['time'], 0.01) / max(b['time'], 0.01)
+        mr = (max(r['peak_growth'], 2**22) /
+              float(max(b['peak_growth'], 2**22)))
+        flag = ''
+        if (tr > 1 + tol) or (mr > 1 + tol):
+            flag = '  <-- regression'
+            bad.append(case_key(r))
+        print "%7.2fx %7.2fx  %s%s" % (tr, mr, case_key(r), flag)
+    return bad
+
+
+def main():
+    parser = OptionParser(usage="%prog [options]")
+    parser.add_option('-o', dest='output', help="write results to FILE",
+                      metavar='FILE')
+    parser.add_option('-b', dest='baseline', metavar='FILE',
+                      help="compare against baseline results FILE")
+    parser.add_option('--tol', type='float', default=0.25,
+                      help="allowed relative slowdown (default 0.25)")
+    parser.add_option('--full', action='store_true', default=False,
+                      help="full product of the grid")
+    parser.add_option('--quick', action='store_true', default=False,
+                      help="small grid")
+    parser.add_option('-r', dest='repeats', type='int', default=3,
+                      help="repeats per case (default 3)")
+    parser.add_option('--case', help=SUPPRESS_HELP)
+    opts, args = parser.parse_args()
+
+    if opts.case:
+        # worker
+        print json.dumps(run_case(json.loads(opts.case), opts.repeats))
+        return 0
+
+    results = run(QUICK if opts.quick else GRID, opts.full, opts.repeats)
+    if opts.output:
+        f = open(opts.output, 'w')
+        json.dump(results, f, indent=1)
+        f.close()
+    if opts.baseline:
+        f = open(opts.baseline)
+        baseline = json.load(f)
+        f.close()
+        bad = compare(results, baseline, opts.tol)
+        if bad:
+            print "\n%i regressions" % len(bad)
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -26,9 +26,22 @@ http://code.google.com/p/pyentropy
 __author__ = 'Robin Ince'
 __version__ = '0.4.1dev'
 
-from systems import DiscreteSystem, SortedDiscreteSystem
-from utils import (prob, decimalise, nsb_entropy, quantise,
-                             dec2base, base2dec)
+from systems import (DiscreteSystem, SortedDiscreteSystem, 
+                     StreamingDiscreteSystem, channel_information, 
+                     window_information)
+from utils import (prob, decimalise, nsb_entropy, nsb_entropy_batch, 
+                   pt_bayescount, pt_bayescount_batch, quantise, 
+                   dec2base, base2dec, unique_words)
 
-from numpy.testing import Tester
-test = Tester().test
+def test(*args, **kwargs):
+    """Run the unit tests (requires nose).
+
+    Arguments are as for ``numpy.testing.Tester.test``. The testing 
+    framework is only imported when this is called.
+
+    """
+    import os
+    from numpy.testing import Tester
+    return Tester(os.path.dirname(__file__)).test(*args, **kwargs)
+# not a test itself
+test.__test__ = False
@@ -0,0 +1,176 @@
+#    This file is part of pyEntropy
+#
+#    pyEntropy is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 2 of the License, or
+#    (at your option) any later version.
+#
+#    pyEntropy is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with pyEntropy. If not, see <http://www.gnu.org/licenses/>.
+#
+#    Copyright 2009, 2010 Robin Ince
+"""
+Exact integer codec for finite alphabet words.
+
+A word of n base-b digits (most significant digit first) is encoded as the
+integer ``sum_i x[i] * b**(n-1-i)``. Encoding uses Horner evaluation in the
+smallest unsigned integer type that holds all ``b**n`` words, so it is exact
+for every word space that fits in 64 bits, and decoding extracts one digit
+at a time without forming a (t, n) power table.
+
+"""
+
+import numpy as np
+
+_UINTS = (np.uint8, np.uint16, np.uint32, np.uint64)
+
+def word_dtype(n, b):
+    """Smallest unsigned integer dtype which holds all length-n base-b words.
+
+    :Parameters:
+      n : int
+        Word length
+      b : int
+        Base (size of finite alphabet)
+
+    :Returns:
+      dtype : numpy dtype
+
+    Raises OverflowError if ``b**n`` words do not fit in 64 bits.
+
+    """
+    top = int(b)**int(n) - 1
+    for t in _UINTS:
+        if top <= np.iinfo(t).max:
+            return np.dtype(t)
+    raise OverflowError, \
+        "%i digit base %i words do not fit in 64 bits" % (n, b)
+
+
+def encode(x, b):
+    """Encode base-b words as integers.
+
+    :Parameters:
+      x : (n, t) int array
+        Array of t length-n base-b words (words are columns). Any integer
+        dtype; x is not copied or upcast as a whole.
+      b : int
+        Base (size of finite alphabet)
+
+    :Returns:
+      d : (t,) unsigned int array
+        Encoded words, of dtype ``word_dtype(n, b)``
+
+    """
+    x = np.atleast_2d(x)
+    if not np.issubdtype(x.dtype, np.integer):
+        raise ValueError, "Input x must be integer"
+    dt = word_dtype(x.shape[0], b)
+    if x.size and ((x.max() >= b) or (x.min() < 0)):
+        raise ValueError, "Input values must be in [0, b)"
+    d = np.zeros(x.shape[1], dtype=dt)
+    base = dt.type(b)
+    for row in x:
+        # Horner step: d = d*b + x_i
+        d *= base
+        d += row.astype(dt, copy=False)
+    return d
+
+
+def decode(d, b, n):
+    """Decode integers to base-b words.
+
+    :Parameters:
+      d : (t,) int array
+        Encoded words (non-negative, less than ``b**n``)
+      b : int
+        Base (size of finite alphabet)
+      n : int
+        Word length
+
+    :Returns:
+      x : (n, t) unsigned int array
+        Words as columns, of dtype ``word_dtype(1, b)``
+
+    """
+    d = np.asarray(d).ravel()
+    if not np.issubdtype(d.dtype, np.integer):
+        raise ValueError, "Input d must be integer"
+    d = d.astype(word_dtype(n, b))
+    x = np.empty((n, d.size), dtype=word_dtype(1, b))
+    base = d.dtype.type(b)
+    for i in xrange(n-1, -1, -1):
+        x[i] = d % base
+        d //= base
+    return x
+
+
+def pack(x):
+    """Bit-pack binary words.
+
+    :Parameters:
+      x : (n, t) int or bool array
+        Array of t length-n binary words (words are columns)
+
+    :Returns:
+      p : (ceil(n/8), t) uint8 array
+        Packed words, ``np.packbits(x, axis=0)``
+
+    """
+    x = np.atleast_2d(x)
+    if x.size and ((x.max() > 1) or (x.min() < 0)):
+        raise ValueError, "Input values must be 0 or 1"
+    return np.packbits(x.astype(np.uint8, copy=False), axis=0)
+
+
+def unpack(p, n):
+    """Unpack bit-packed binary words.
+
+    :Parameters:
+      p : (ceil(n/8), t) uint8 array
+        Packed words (see pack)
+      n : int
+        Word length
+
+    :Returns:
+      x : (n, t) uint8 array
+
+    """
+    return np.unpackbits(np.asarray(p, dtype=np.uint8), axis=0)[:n]
+
+
+def packed_words(p, n):
+    """Encode bit-packed binary words as integers.
+
+    The packed bytes of each word are reinterpreted as a big-endian 
+    unsigned integer, so the result is the same as ``encode(unpack(p, n), 
+    2)`` without unpacking.
+
+    :Parameters:
+      p : (ceil(n/8), t) uint8 array
+        Packed words (see pack)
+      n : int
+        Word length
+
+    :Returns:
+      d : (t,) unsigned int array
+        Encoded words, of dtype ``word_dtype(n, 2)``
+
+    """
+    p = np.asarray(p, dtype=np.uint8)
+    nb = p.shape[0]
+    if nb != (n + 7) // 8:
+        raise ValueError, "Packed input does not match word length"
+    dt = word_dtype(n, 2)
+    k = dt.itemsize
+    # left pad each word to k bytes and view as big-endian integers
+    buf = np.zeros((p.shape[1], k), dtype=np.uint8)
+    buf[:,k-nb:] = p.T
+    d = buf.view('>u%i' % k).ravel().astype(dt)
+    # drop the padding bits of the last byte
+    return d >> dt.type(8*nb - n)
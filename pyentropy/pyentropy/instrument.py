@@ -0,0 +1,145 @@
+#    This file is part of pyEntropy
+#
+#    pyEntropy is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 2 of the License, or
+#    (at your option) any later version.
+#
+#    pyEntropy is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with pyEntropy. If not, see <http://www.gnu.org/licenses/>.
+#
+#    Copyright 2009, 2010 Robin Ince
+"""
+Opt-in instrumentation of entropy calculations.
+
+A :class:`Recorder` collects per-stage wall times, event counters and the
+sizes of the main arrays allocated during a calculation. It is enabled
+with the ``instrument`` keyword of ``calculate_entropies``::
+
+    s.calculate_entropies(method='pt', calc=['HX','HXY'], instrument=True)
+    s.stats.timings   # {'count': 0.012, 'pt': 0.003, ...}
+    s.stats.counts    # {'pt_bayescount': 3, 'pt_iterations': 41, ...}
+    s.stats.sizes     # {'XY': 5184, 'PXY': 5184, ...} (bytes)
+
+A callable can be passed instead of True; it is called as
+``callback(kind, name, value)`` for every record, with kind one of
+'time', 'count' or 'size', so the values can be forwarded to other
+metrics systems.
+
+When no recorder is active the hooks are a single global check, so the
+overhead of disabled instrumentation is negligible. Calculations run in
+other processes (eg a QE executor ``multiprocessing.Pool``) are not
+recorded.
+
+"""
+from __future__ import with_statement
+import time
+
+# currently active Recorder (None when disabled)
+_active = None
+
+class Recorder(object):
+    """Collects timings, counters and allocation sizes.
+
+    :Attributes:
+      timings : dict
+        Total wall time (seconds) of each stage
+      calls : dict
+        Number of times each stage was entered
+      counts : dict
+        Event counters
+      sizes : dict
+        Largest allocation (bytes) recorded for each array
+
+    """
+
+    def __init__(self, callback=None):
+        self.callback = callback
+        self.timings = {}
+        self.calls = {}
+        self.counts = {}
+        self.sizes = {}
+
+    def time(self, name, t):
+        self.timings[name] = self.timings.get(name, 0.0) + t
+        self.calls[name] = self.calls.get(name, 0) + 1
+        if self.callback is not None:
+            self.callback('time', name, t)
+
+    def count(self, name, n=1):
+        self.counts[name] = self.counts.get(name, 0) + n
+        if self.callback is not None:
+            self.callback('count', name, n)
+
+    def size(self, name, nbytes):
+        self.sizes[name] = max(self.sizes.get(name, 0), nbytes)
+        if self.callback is not None:
+            self.callback('size', name, nbytes)
+
+
+class _Stage(object):
+    """Context manager timing a stage into the active recorder"""
+
+    def __init__(self, rec, name):
+        self.rec = rec
+        self.name = name
+
+    def __enter__(self):
+        self.t0 = time.time()
+
+    def __exit__(self, *exc):
+        self.rec.time(self.name, time.time() - self.t0)
+        return False
+
+
+class _NullStage(object):
+    def __enter__(self):
+        pass
+
+    def __exit__(self, *exc):
+        return False
+
+_NULL = _NullStage()
+
+
+def stage(name):
+    """Context manager which times the enclosed block as stage name"""
+    if _active is None:
+        return _NULL
+    return _Stage(_active, name)
+
+
+def count(name, n=1):
+    """Add n to counter name"""
+    if _active is not None:
+        _active.count(name, n)
+
+
+def size(name, a):
+    """Record the size of array a"""
+    if _active is not None:
+        _active.size(name, a.nbytes)
+
+
+class recording(object):
+    """Context manager activating a Recorder (or nothing if rec is None)"""
+
+    def __init__(self, rec):
+        self.rec = rec
+
+    def __enter__(self):
+        global _active
+        self.prev = _active
+        if self.rec is not None:
+            _active = self.rec
+        return self.rec
+
+    def __exit__(self, *exc):
+        global _active
+        _active = self.prev
+        return False
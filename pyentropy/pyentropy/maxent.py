@@ -53,18 +53,18 @@ represented, when interpreted as a base m, length n word. eg for n=3,m=3::
     P[4] = P(0,1,1) etc.
 
 This allows efficient vectorised conversion between probability index and 
-response word using base2dec, dec2base. The output is in the same format.
+response word using pyentropy.codec. The output is in the same format.
 
 """
 import time
 import os
 import sys
 import cPickle
+import itertools
 import numpy as np
-import scipy as sp
-import scipy.io as sio
-import scipy.sparse as sparse
-import scipy.optimize as opt
+# scipy modules are imported when needed (generating, loading and saving
+# matrices, solving) to keep the import light. scipy.sparse.linalg itself
+# imports scipy.optimize.
 # umfpack disabled due to bug in scipy
 # http://mail.scipy.org/pipermail/scipy-user/2009-December/023625.html
 #try:
@@ -73,9 +73,7 @@ import scipy.optimize as opt
 #except:
     #HAS_UMFPACK = False
 HAS_UMFPACK = False
-from scipy.sparse.linalg import spsolve, use_solver
-use_solver(useUmfpack=False)
-from utils import dec2base, base2dec
+from codec import decode
 import ConfigParser
 
 def get_config_file():
@@ -184,6 +182,7 @@ class AmariSolve:
         # if file exists load (matrix A)
         # must be running in correct directory
         if os.path.exists(self.filename+'.mat'):
+            import scipy.io as sio
             loaddict = sio.loadmat(self.filename+'.mat')
             self.A = loaddict['A'].tocsc()
             self.order_idx = loaddict['order_idx'].squeeze()
@@ -223,8 +222,9 @@ class AmariSolve:
         self.order_length    = np.zeros(n+1, dtype=int)
         self.row_counter     = 0
 
+        from scipy.special import comb
         for ordi in xrange(n+1):    
-            self.order_length[ordi] = (sp.comb(n, ordi+1, exact=1) * 
+            self.order_length[ordi] = (comb(n, ordi+1, exact=1) * 
                                         ((m-1)**(ordi+1)))
             self.order_idx[ordi] = self.row_counter
             self.row_counter += self.order_length[ordi]
@@ -239,7 +239,14 @@ class AmariSolve:
         self.Annz = np.sum(x*y.T)
         
     def _generate_matrix(self):
-        """Generate A matrix if required"""
+        """Generate A matrix if required
+        
+        Row r of A is the marginal of a set of positions taking a set of 
+        (non-zero) values alpha. Its columns are the (non-zero) words which 
+        have those values at those positions. Within each order the rows 
+        are ordered by (alpha_1, pos_1, ..., alpha_o, pos_o).
+
+        """
         k = self.k
         n = self.n
         m = self.m
@@ -247,64 +254,40 @@ class AmariSolve:
 
         self._calculate_orders()
 
-        self.A = sparse.dok_matrix((self.order_idx[k],dim))
-
-        self.row_counter = 0
+        # place value of each position in the word
+        w = m**np.arange(n-1, -1, -1, dtype=np.int64)
+        rows = []
+        cols = []
         for ordi in xrange(k):
-            self.nterms = m**(n - (ordi+1))
-            self.terms = dec2base(np.c_[0:self.nterms,], m, n-(ordi+1))
-            self._recloop((ordi+1), 1, [], [], n, m)
-            print "Order " + str(ordi+1) + " complete. Time: " + time.ctime()
+            order = ordi + 1
+            alpha, pos = _marginal_index(n, m, order)
+            nrows = alpha.shape[0]
+            nterms = m**(n - order)
+            # free positions of each row (in increasing order)
+            free = np.ones((nrows, n), dtype=bool)
+            free[np.arange(nrows)[:,np.newaxis], pos] = False
+            free = np.nonzero(free)[1].reshape(nrows, n - order)
+            # all words over the free positions
+            terms = decode(np.arange(nterms), m, n - order).astype(np.int64)
+            c = np.dot(w[free], terms)
+            c += (alpha * w[pos]).sum(axis=1)[:,np.newaxis] - 1
+            cols.append(c.ravel())
+            rows.append(np.repeat(np.arange(self.order_idx[ordi], 
+                                            self.order_idx[ordi] + nrows), 
+                                  nterms))
+            print "Order " + str(order) + " complete. Time: " + time.ctime()
+
+        rows = np.concatenate(rows)
+        cols = np.concatenate(cols)
+        import scipy.sparse as sparse
+        self.A = sparse.coo_matrix((np.ones(rows.size), (rows, cols)),
+                                   shape=(self.order_idx[k], dim)).tocsc()
 
         # save matrix to file
-        self.A = self.A.tocsc()
         savedict = {'A':self.A, 'order_idx':self.order_idx}
+        import scipy.io as sio
         sio.savemat(self.filename, savedict)
 
-    def _recloop(self, order, depth, alpha, pos, n, m, blocksize=None):
-        terms = self.terms
-        A = self.A
-        if not blocksize:
-            blocksize = self.nterms
-
-        # starting point for position loop
-        if len(pos)==0:
-            pos_start = 0
-        else:
-            pos_start = pos[-1] + 1
-
-        # loop over alphabet
-        for ai in xrange(1, m):
-            alpha_new = list(alpha)
-            alpha_new.append(ai)
-
-            # loop over position
-            for pi in xrange(pos_start, (n-(order-depth))):
-                pos_new = list(pos)
-                pos_new.append(pi)
-
-                # add columns?
-                if depth == order:
-                    # special case for highest order
-                    # (can't insert columns into empty terms array)
-                    if order==n:
-                        cols = base2dec(np.atleast_2d(alpha_new),m)[0]-1
-                        A[self.row_counter, cols] = 1
-                    else:    
-                        # add columns (insert and add to sparse)
-                        ins = np.tile(alpha_new,(blocksize,1))
-                        temp = terms
-                        for coli in xrange(order):
-                            temp = inscol(temp, np.array(ins[:,coli],ndmin=2).T, pos_new[coli])
-
-                        cols = (base2dec(temp,m)-1).tolist()
-
-                        A[self.row_counter, cols] = 1;
-
-                    self.row_counter += 1
-                else:
-                    self._recloop(order, depth+1, alpha_new, pos_new, n, m, blocksize=blocksize)
-
     def solve(self,Pr,k,eta_given=False,ic_offset=-0.01, **kwargs):
         """Find maxent distribution for a given order k
         
@@ -354,8 +337,9 @@ class AmariSolve:
         if eta_given:
             eta_sampled = Pr[:l]
         else:
-            eta_sampled = Asmall.matvec(Pr[1:])
+            eta_sampled = Asmall.dot(Pr[1:])
 
+        import scipy.optimize as opt
         if jacobian:
             self.optout = opt.fsolve(sf, x0, (Asmall,Bsmall,eta_sampled, l), 
                 fprime=self._jacobian, col_deriv=1, full_output=1)
@@ -382,16 +366,17 @@ class AmariSolve:
         return Psolve
 
     def _solvefunc(self, theta_un, Asmall, Bsmall, eta_sampled, l):
-        b = np.exp(Bsmall.matvec(theta_un))
-        y = eta_sampled - ( Asmall.matvec(b) / (b.sum()+1) )
+        b = np.exp(Bsmall.dot(theta_un))
+        y = eta_sampled - ( Asmall.dot(b) / (b.sum()+1) )
         return y
 
     def _jacobian(self, theta, Asmall, Bsmall, eta_sampled, l):
-        x = np.exp(Bsmall.matvec(theta))
-        p = Asmall.matvec(x)
+        x = np.exp(Bsmall.dot(theta))
+        p = Asmall.dot(x)
         q = x.sum() + 1
 
         J = np.outer(p,p)
+        import scipy.sparse as sparse
         xd = sparse.spdiags(x,0,x.size,x.size,format='csc')
         qdp = (Asmall * xd) * Bsmall
         qdp *= q
@@ -403,7 +388,7 @@ class AmariSolve:
     def _p_from_theta(self, theta):
         """Internal version - stays in dim space (missing p[0])"""
         pnorm = lambda p: ( p / (p.sum()+1) )
-        return pnorm(np.exp(self.A.T.matvec(theta)))
+        return pnorm(np.exp(self.A.T.dot(theta)))
 
     def p_from_theta(self, theta):
         """Return full ``fdim`` p-vector from ``fdim-1`` length theta"""
@@ -419,31 +404,42 @@ class AmariSolve:
             # use prefactored matrix
             theta = self.umf.solve(um.UMFPACK_A, self.B, b, autoTranspose=True)
         else:
+            from scipy.sparse.linalg import spsolve, use_solver
+            use_solver(useUmfpack=False)
             theta = spsolve(self.B, b)
         # add theta(0) or not?
         return theta
 
     def eta_from_p(self, p):
         """Return eta-vector (marginals) from full probability vector"""
-        return self.A.matvec(p[1:])
+        return self.A.dot(p[1:])
 
 
-def inscol(x,h,n):
-    xs = x.shape
-    hs = h.shape
- 
-    if hs[0]==1:    # row vector
-        h=h.T
-        hs=h.shape
+def _marginal_index(n, m, order):
+    """Values and positions of the marginals of a given order
+    
+    :Returns:
+      alpha : (r, order) int array
+        Values (1..m-1) of each marginal
+      pos : (r, order) int array
+        Positions (increasing) of each marginal
 
-    if n==0:
-        y = np.hstack((h,x))
-    elif n==xs[1]:
-        y = np.hstack((x,h))
-    else:
-        y = np.hstack((x[:,:n],h,x[:,n:]))
+    Rows are ordered by (alpha_1, pos_1, ..., alpha_o, pos_o), the row
+    order of A.
 
-    return y
+    """
+    combs = np.array(list(itertools.combinations(range(n), order)), 
+                     dtype=np.int64)
+    vals = decode(np.arange((m-1)**order), m-1, order).T.astype(np.int64) + 1
+    alpha = np.repeat(vals, combs.shape[0], axis=0)
+    pos = np.tile(combs, (vals.shape[0], 1))
+    # lexsort uses the last key as the primary key
+    keys = []
+    for i in xrange(order-1, -1, -1):
+        keys.append(pos[:,i])
+        keys.append(alpha[:,i])
+    idx = np.lexsort(keys)
+    return alpha[idx], pos[idx]
 
 
 def order1direct(p,a):
@@ -460,7 +456,7 @@ def order1direct(p,a):
 
     # loop over all probabilities (not p(0))
     for i in range(1,a.fdim):
-        Pword = dec2base(np.atleast_2d(i).T,a.m,a.n)
+        Pword = decode(np.atleast_1d(i),a.m,a.n).T
 
         # loop over each variable
         for j in range(a.n):
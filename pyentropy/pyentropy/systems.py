@@ -15,50 +15,37 @@
 #
 #    Copyright 2009, 2010 Robin Ince
 
-from __future__ import division
+from __future__ import division, with_statement
 import numpy as np
-from utils import (prob, _probcount, decimalise, pt_bayescount, 
-                   nsb_entropy, dec2base, ent, malog2)
+from utils import (_probcount, pt_bayescount, pt_bayescount_batch, 
+                   nsb_entropy, nsb_entropy_batch, unique_words, ent, _cross_ent)
+from codec import encode, decode, pack, unpack, packed_words
+from instrument import Recorder, recording, stage, size
+
+# default number of trials read at a time
+_BLOCK = 2**18
+# default number of X words per block when constructing PiX
+_PIX_BLOCK = 2**16
+# window positions between exact recomputation of running entropy sums
+_RESYNC = 1024
 
 class BaseSystem:
     """Base functionality for entropy calculations common to all systems"""
 
-    def _calc_ents(self, method, sampling, methods):
+    def _calc_ents(self, method, sampling, methods, counts=None):
         """Main entropy calculation function for non-QE methods"""
 
-        self._sample(method=sampling)
+        self._sample(method=sampling, counts=counts)
         pt = (method == 'pt') or ('pt' in methods)
         plugin = (method == 'plugin') or ('plugin' in methods)
         nsb = (method == 'nsb') or ('nsb' in methods)
-        calc = self.calc
 
         if (pt or plugin): 
-            self._calc_pt_plugin(pt)
+            with stage('pt' if pt else 'plugin'):
+                self._calc_pt_plugin(pt)
         if nsb:
-            self._calc_nsb()
-        if 'HshXY' in calc:
-            #TODO: not so efficient since samples PY again
-            sh = self._sh_instance()
-            sh.calculate_entropies(method=method, 
-                                   sampling=sampling, 
-                                   methods=methods, calc=['HXY'])
-            if pt: 
-                self.H_pt['HshXY'] = sh.H_pt['HXY']
-            if nsb: 
-                self.H_nsb['HshXY'] = sh.H_nsb['HXY']
-            if plugin or pt: 
-                self.H_plugin['HshXY'] = sh.H_plugin['HXY']
-        if 'HshX' in calc:
-            sh = self._shX_instance()
-            sh.calculate_entropies(method=method,
-                                   sampling=sampling,
-                                   methods=methods, calc=['HX'])
-            if pt: 
-                self.H_pt['HshX'] = sh.H_pt['HX']
-            if nsb: 
-                self.H_nsb['HshX'] = sh.H_nsb['HX']
-            if plugin or pt: 
-                self.H_plugin['HshX'] = sh.H_plugin['HX']
+            with stage('nsb'):
+                self._calc_nsb()
             
         if method == 'plugin':
             self.H = self.H_plugin
@@ -78,7 +65,8 @@ class BaseSystem:
             H = ent(self.PX)
             self.H_plugin['HX'] = H
             if pt:
-                self.H_pt['HX'] = H + pt_corr(pt_bayescount(self.PX, self.N))
+                self.H_pt['HX'] = H + pt_corr(pt_bayescount(self.PX, self.N,
+                                                             self.X_dim))
         if 'HY' in calc:
             H = ent(self.PY)
             self.H_plugin['HY'] = H
@@ -88,24 +76,40 @@ class BaseSystem:
             H = (self.PY * ent(self.PXY)).sum()
             self.H_plugin['HXY'] = H
             if pt:
-                for y in xrange(self.Y_dim):
-                    H += pt_corr(pt_bayescount(self.PXY[:,y], self.Ny[y]))
+                R = pt_bayescount_batch(self.PXY, self.Ny, self.X_dim)
+                H += pt_corr(R).sum()
                 self.H_pt['HXY'] = H
         if 'SiHXi' in calc:
             H = ent(self.PXi).sum()
             self.H_plugin['SiHXi'] = H
             if pt:
-                for x in xrange(self.X_n):
-                    H += pt_corr(pt_bayescount(self.PXi[:,x],self.N))
+                H += pt_corr(pt_bayescount_batch(self.PXi, self.N)).sum()
                 self.H_pt['SiHXi'] = H
         if 'HiXY' in calc:
             H = (self.PY * ent(self.PXiY)).sum()
             self.H_plugin['HiXY'] = H
             if pt:
-                for x in xrange(self.X_n):
-                    for y in xrange(self.Y_dim):
-                        H += pt_corr(pt_bayescount(self.PXiY[:,x,y],self.Ny[y]))
+                R = pt_bayescount_batch(self.PXiY.reshape((self.X_m,-1)),
+                                        np.tile(self.Ny, self.X_n))
+                H += pt_corr(R).sum()
                 self.H_pt['HiXY'] = H
+        # shuffled entropies are averaged over the shuffles (axis 1)
+        if 'HshXY' in calc:
+            n_sh = self.PshXY.shape[1]
+            H = (self.PY * ent(self.PshXY)).sum() / n_sh
+            self.H_plugin['HshXY'] = H
+            if pt:
+                R = pt_bayescount_batch(
+                        self.PshXY.reshape((self.PshXY.shape[0],-1)),
+                        np.tile(self.Ny, n_sh), self.X_dim)
+                H += pt_corr(R).sum() / n_sh
+                self.H_pt['HshXY'] = H
+        if 'HshX' in calc:
+            H = ent(self.PshX).mean()
+            self.H_plugin['HshX'] = H
+            if pt:
+                R = pt_bayescount_batch(self.PshX, self.N, self.X_dim)
+                self.H_pt['HshX'] = H + pt_corr(R).mean()
         if 'HiX' in calc:
             H = ent(self.PiX)
             self.H_plugin['HiX'] = H
@@ -113,8 +117,14 @@ class BaseSystem:
                 # no PT correction for HiX
                 self.H_pt['HiX'] = H
         if 'ChiX' in calc:
-            H = -(self.PX*malog2(np.ma.array(self.PiX,copy=False,
-                    mask=(self.PiX<=np.finfo(np.float).eps)))).sum(axis=0)
+            # only words with P(x) > 0 contribute. log2 Pind is evaluated
+            # in log space, since Pind of long words underflows
+            occ = np.flatnonzero(self.PX)
+            L = _pind(self.PXiY, self.PY, self.X_dim, 
+                      getattr(self, 'pix_block', _PIX_BLOCK), occ,
+                      getattr(self, 'X_words', None), log=True)
+            fin = np.isfinite(L)
+            H = 0.0 - np.dot(self.PX[occ][fin], L[fin])
             self.H_plugin['ChiX'] = H
             if pt:
                 # no PT correction for ChiX
@@ -127,13 +137,14 @@ class BaseSystem:
             H = ent(self.PXY[:,1])
             self.H_plugin['HXY1'] = H
             if pt:
-                self.H_pt['HXY1'] = H + pt_corr(pt_bayescount(self.PXY[:,1],self.Ny[1])) 
+                R = pt_bayescount(self.PXY[:,1], self.Ny[1], self.X_dim)
+                self.H_pt['HXY1'] = H + pt_corr(R)
         if 'ChiXY1' in calc:
             if self.Y_m != 2:
                 raise ValueError, \
                 "ChiXY1 calculation only makes sense for spike data, ie Y_m = 2"
-            H = -np.ma.array(self.PXY[:,1]*np.log2(self.PX),copy=False,
-                    mask=(self.PX<=np.finfo(np.float).eps)).sum()
+            occ = np.flatnonzero(self.PXY[:,1])
+            H = _cross_ent(self.PXY[occ,1], self.PX[occ])
             self.H_plugin['ChiXY1'] = H
             if pt:
                 # no PT for ChiXY1
@@ -142,7 +153,6 @@ class BaseSystem:
     def _calc_nsb(self):
         """Calculate NSB corrected entropy"""
         calc = self.calc
-        # TODO: 1 external program call if all y have same number of trials
         self.H_nsb = {}
         if 'HX' in calc:
             H = nsb_entropy(self.PX, self.N, self.X_dim)[0] / np.log(2)
@@ -151,27 +161,166 @@ class BaseSystem:
             H = nsb_entropy(self.PY, self.N, self.Y_dim)[0] / np.log(2)
             self.H_nsb['HY'] = H
         if 'HXY' in calc:
-            H = 0.0
-            for y in xrange(self.Y_dim):
-                H += self.PY[y] * nsb_entropy(self.PXY[:,y], self.Ny[y], self.X_dim)[0] \
-                        / np.log(2)
-            self.H_nsb['HXY'] = H
+            # all output conditional distributions in one batch
+            H = nsb_entropy_batch(self.PXY, self.Ny, self.X_dim)[0]
+            self.H_nsb['HXY'] = (self.PY * H).sum() / np.log(2)
         if 'SiHXi' in calc:
-            # TODO: can easily use 1 call here
-            H = 0.0
-            for i in xrange(self.X_n):
-                H += nsb_entropy(self.PXi[:,i], self.N, self.X_m)[0] / np.log(2)
-            self.H_nsb['SiHXi'] = H
+            H = nsb_entropy_batch(self.PXi, self.N, self.X_m)[0]
+            self.H_nsb['SiHXi'] = H.sum() / np.log(2)
         if 'HiXY' in calc:
-            H = 0.0
-            for i in xrange(self.X_n):
-                for y in xrange(self.Y_dim):
-                    H += self.PY[y] * nsb_entropy(self.PXiY[:,i,y], self.Ny[y], self.X_m)[0] / np.log(2)
-            self.H_nsb['HiXY'] = H
+            H = nsb_entropy_batch(self.PXiY.reshape((self.X_m,-1)), 
+                                  np.tile(self.Ny, self.X_n), self.X_m)[0]
+            H = H.reshape((self.X_n,self.Y_dim)).sum(axis=0)
+            self.H_nsb['HiXY'] = (self.PY * H).sum() / np.log(2)
+        if 'HshXY' in calc:
+            n_sh = self.PshXY.shape[1]
+            P = self.PshXY.reshape((self.PshXY.shape[0],-1))
+            H = nsb_entropy_batch(P, np.tile(self.Ny, n_sh), self.X_dim)[0]
+            H = H.reshape((n_sh,self.Y_dim)).sum(axis=0) / n_sh
+            self.H_nsb['HshXY'] = (self.PY * H).sum() / np.log(2)
+        if 'HshX' in calc:
+            H = nsb_entropy_batch(self.PshX, self.N, self.X_dim)[0]
+            self.H_nsb['HshX'] = H.mean() / np.log(2)
         if 'HiX' in calc:
             H = nsb_entropy(self.PiX, self.N, self.X_dim)[0] / np.log(2)
             self.H_nsb['HiX'] = H
 
+    def _sample(self, method='naive', counts=None):
+        """Sample probabilities of system.
+
+        Parameters
+        ----------
+        method : {'naive', 'beta:x', 'kt'}, optional
+            Sampling method to use. 'naive' is the standard histrogram method.
+            'beta:x' is for an add-constant beta estimator, with beta value
+            following the colon eg 'beta:0.01' [1]_. 'kt' is for the 
+            Krichevsky-Trofimov estimator [2]_, which is equivalent to 
+            'beta:0.5'.
+        counts : dict, optional
+            Count tables (as returned by ``_count``) to sample from. If not
+            given the tables are counted from all trials of the system.
+
+        References
+        ----------
+        .. [1] T. Schurmann and P. Grassberger, "Entropy estimation of 
+           symbol sequences," Chaos,vol. 6, no. 3, pp. 414--427, 1996.
+        .. [2] R. Krichevsky and V. Trofimov, "The performance of universal 
+           encoding," IEEE Trans. Information Theory, vol. 27, no. 2, 
+           pp. 199--207, Mar. 1981. 
+
+        """
+        if counts is None:
+            counts = self._kept_counts('full')[0]
+        with stage('probabilities'):
+            self._set_probs(counts, method)
+        self.sampled = True
+
+    def _kept_counts(self, key):
+        """Count tables of all trials ('full') or of the QE quarters ('qe').
+
+        The integer tables are kept between calls and only recounted when
+        calc needs tables they do not have (or a different number of 
+        shuffles), so changing method, sampling or a subset of calc does 
+        not histogram the data again. Probabilities are derived from the 
+        kept counts for each sampling scheme.
+
+        """
+        calc = set(self.calc)
+        n_sh = getattr(self, 'n_shuffles', 1)
+        if not (('HshXY' in calc) or ('HshX' in calc)):
+            n_sh = None
+        kept = getattr(self, '_counts_kept', None)
+        if kept is None:
+            kept = self._counts_kept = {}
+        if key in kept:
+            kcalc, kn_sh, counts = kept[key]
+            if calc <= kcalc and (n_sh is None or n_sh == kn_sh):
+                return counts
+            if n_sh is None:
+                n_sh = kn_sh
+            elif n_sh != kn_sh:
+                # new shuffles for the other shuffled tables too
+                kcalc = kcalc - set(['HshXY','HshX'])
+            calc = calc | kcalc
+        user_calc = self.calc
+        self.calc = list(calc)
+        try:
+            with stage('count'):
+                if key == 'qe':
+                    counts = self._count(self._qe_prep(), 4)
+                else:
+                    counts = self._count()
+        finally:
+            self.calc = user_calc
+        for k, v in counts[0].iteritems():
+            if isinstance(v, np.ndarray):
+                size(k, v)
+        kept[key] = (calc, n_sh, counts)
+        return counts
+
+    def _set_probs(self, counts, method):
+        """Set probability attributes from a dict of count tables"""
+        calc = self.calc
+        self.N = counts['N']
+        self.Ny = counts['Ny'].astype(float)
+
+        # unconditional probabilities
+        if 'X' in counts:
+            self.PX = _probcount(counts['X'], self.N, method)
+        if any([c in calc for c in ['HXY','HiX','HiXY','HY','HshXY','ChiX']]):
+            self.PY = _probcount(self.Ny, self.N, method)
+        if 'SiHXi' in calc:
+            self.PXi = _probcount(counts['Xi'], self.N, method)
+        if 'HshX' in calc:
+            self.PshX = _probcount(counts['shX'], self.N, method)
+
+        # conditional probabilities
+        if 'XY' in counts:
+            self.PXY = self._condprob(counts['XY'], method)
+        if 'XiY' in counts:
+            self.PXiY = self._condprob(counts['XiY'], method)
+        if 'HshXY' in calc:
+            self.PshXY = self._condprob(counts['shXY'], method)
+        for k in ('PX','PY','PXi','PshX','PXY','PXiY','PshXY'):
+            if k in self.__dict__:
+                size(k, self.__dict__[k])
+        # observed words (sparse mode)
+        self.X_words = counts.get('words', None)
+        # Pind(X) = <Pind(X|Y)>_y
+        # (ChiX alone only needs Pind at the occupied words)
+        if 'HiX' in calc:
+            self.PiX = _pind(self.PXiY, self.PY, self.X_dim, 
+                             getattr(self, 'pix_block', _PIX_BLOCK))
+
+    def _Xi_counts(self, X, g=None, n_g=1):
+        """Count tables for the individual variables of trials X.
+
+        A single bincount over all variables and trial groups ``g`` (labels
+        in [0, n_g)) returns C (X_m, X_n, n_g), with ``C[i,j,k]`` the
+        number of trials in group k with ``X_j==i``.
+
+        """
+        X_m = self.X_m
+        X_n = self.X_n
+        # combined index of value, variable and group (in np.intp, the
+        # input dtype may be too small)
+        idx = X.astype(np.intp) + X_m*np.arange(X_n)[:,np.newaxis]
+        if g is not None:
+            idx += (X_m*X_n)*np.asarray(g, dtype=np.intp)
+        C = np.bincount(idx.ravel(), minlength=X_m*X_n*n_g)
+        return C.reshape((n_g,X_n,X_m)).transpose()
+
+    def _condprob(self, C, method):
+        """Conditional probabilities from a count table with Y on the last
+        axis. Distributions for outputs with no trials are left as zero."""
+        null = (self.Ny == 0)
+        for i in np.flatnonzero(null):
+            print 'Warning: Null output conditional ensemble for ' + \
+              'output : ' + str(i)
+        P = _probcount(C, np.where(null, 1, self.Ny), method)
+        P[...,null] = 0
+        return P
+
     def calculate_entropies(self, method='plugin', sampling='naive', 
                             calc=['HX','HXY'], **kwargs):
         """Calculate entropies of the system.
@@ -198,6 +347,29 @@ class BaseSystem:
             If present, method argument will be ignored, and all corrections 
             in the list will be calculated. Use to comparing results of 
             different methods with one calculation pass.
+          n_shuffles : int, optional
+            Number of independent shuffles for 'HshXY' and 'HshX'. The 
+            shuffled entropies are averaged over the shuffles (default 1).
+          instrument : {False, True} or callable, optional
+            If given, per-stage timings, counters and array sizes of the 
+            calculation are recorded in ``self.stats`` (a 
+            :class:`pyentropy.instrument.Recorder`). A callable is also 
+            called as ``callback(kind, name, value)`` for every record.
+          recount : {False, True}, optional
+            Count tables are kept between calls, so further calls with 
+            other methods, sampling schemes or a subset of calc do not 
+            histogram the data again (the same shuffles and QE partitions 
+            are used). Set to True to discard them and count again.
+          pix_block : int, optional
+            Number of X words processed at a time when constructing PiX 
+            for 'HiX' and 'ChiX' (default 2**16). Temporary memory is about
+            ``pix_block * (X_n + 8*Y_dim)`` bytes. Without 'HiX', 'ChiX' 
+            only evaluates PiX at the words with P(x) > 0.
+          executor : pool, optional
+            Object with a ``map`` method, eg a ``multiprocessing.Pool`` or 
+            ``multiprocessing.pool.ThreadPool``. If given, the full, half and
+            quarter length QE evaluations are run concurrently with it. 
+            Results are identical to serial evaluation.
 
         :Returns:
           self.H : dict
@@ -222,38 +394,40 @@ class BaseSystem:
         """
         self.calc = calc
         self.methods = kwargs.get('methods',[])
+        if kwargs.get('recount', False):
+            self._counts_kept = None
+        self.pix_block = kwargs.get('pix_block', _PIX_BLOCK)
+        self.n_shuffles = kwargs.get('n_shuffles', 1)
+        if self.n_shuffles < 1:
+            raise ValueError, "n_shuffles must be at least 1"
         for m in (self.methods + [method]):
             if m not in ('plugin','pt','qe','nsb'):
                 raise ValueError, 'Unknown correction method : '+str(m)
         methods = self.methods
-
-        # allocate memory for requested calculations
-        if any([c in calc for c in ['HXY','HiXY','HY']]):
-            # need Py for any conditional entropies
-            self.PY = np.zeros(self.Y_dim)
-        if any([c in calc for c in ['HX','HshX','ChiX','ChiXY1']]):
-            self.PX = np.zeros(self.X_dim)
-        if ('HiX' in calc) or ('ChiX' in calc):
-            self.PiX = np.zeros(self.X_dim)
-        if any([c in calc for c in ['HXY','HXY1','ChiXY1']]):
-            self.PXY = np.zeros((self.X_dim,self.Y_dim))
-        if 'SiHXi' in calc:
-            self.PXi = np.zeros((self.X_m,self.X_n))
-        if ('HiXY' in calc) or ('HiX' in calc):
-            self.PXiY = np.zeros((self.X_m,self.X_n,self.Y_dim))
-        if 'HshXY' in calc:
-            self.Xsh = np.zeros(self.X.shape,dtype=np.int)
-
-        if (method == 'qe') or ('qe' in methods):
-            # default to plugin method if not specified
-            qe_method = kwargs.get('qe_method','plugin')
-            if qe_method == 'qe':
-                raise ValueError, "Can't use qe for qe_method!"
-            self._qe_ent(qe_method,sampling,methods)
-            if method == 'qe':
-                self.H = self.H_qe
-        else:
-            self._calc_ents(method, sampling, methods)
+        if getattr(self, 'sparse', False) and ('HiX' in calc):
+            raise ValueError, "HiX is not available in sparse mode"
+        if getattr(self, 'sparse', False) and (sampling.lower() != 'naive'):
+            raise ValueError, "Only naive sampling is available in sparse mode"
+
+        instrument = kwargs.get('instrument', None)
+        rec = None
+        if instrument:
+            rec = Recorder(None if instrument is True else instrument)
+            self.stats = rec
+
+        with recording(rec):
+            with stage('total'):
+                if (method == 'qe') or ('qe' in methods):
+                    # default to plugin method if not specified
+                    qe_method = kwargs.get('qe_method','plugin')
+                    if qe_method == 'qe':
+                        raise ValueError, "Can't use qe for qe_method!"
+                    self._qe_ent(qe_method,sampling,methods,
+                                 kwargs.get('executor',None))
+                    if method == 'qe':
+                        self.H = self.H_qe
+                else:
+                    self._calc_ents(method, sampling, methods)
 
     def I(self, corr=None):
         """Convenience function to compute mutual information
@@ -350,48 +524,79 @@ class BaseSystem:
             return
         return I
 
-    def _qe_ent(self, qe_method, sampling, methods):
-        """General Quadratic Extrapolation Function"""
-        calc = self.calc
-        self._qe_prep()
-        N = self.N
-        N2 = N/2.0
-        N4 = N/4.0
-
-        # full length
-        # add on methods to do everything (other than qe) with this one call
-        self._calc_ents(qe_method,sampling,methods)
-        H1 = np.array([v for k,v in sorted(self.H.iteritems())])
-        
-        # half length
-        H2 = np.zeros(H1.shape)
-        half_slices = [(2,0), (2,1)]
-        for sl in half_slices:
-            sys = self._subsampled_instance(sl)
-            sys.calculate_entropies(method=qe_method, sampling=sampling, calc=calc)
-            H2 += np.array([v for k,v in sorted(sys.H.iteritems())])
-            del sys
-        H2 = H2 / 2.0
-        
-        # quarter length
-        H4 = np.zeros(H1.shape)
-        quarter_slices = [(4,0), (4,1), (4,2), (4,3)]
-        for sl in quarter_slices:
-            sys = self._subsampled_instance(sl)
-            sys.calculate_entropies(method=qe_method, sampling=sampling, calc=calc)
-            H4 += np.array([v for k,v in sorted(sys.H.iteritems())])
-            del sys
-        H4 = H4 / 4.0
+    def _qe_ent(self, qe_method, sampling, methods, executor=None):
+        """General Quadratic Extrapolation Function
+
+        The trials are histogrammed once into four quarter partitions.
+        Half and full length count tables are sums of the quarter tables,
+        so every term is evaluated from counts without resampling the data.
+        The evaluations are independent and are mapped over executor if
+        one is given.
+
+        """
+        quarters = self._kept_counts('qe')
+        halves = [_addcounts(quarters[:2]), _addcounts(quarters[2:])]
+        full = _addcounts(halves)
+
+        # all shuffling is done above, so evaluations are deterministic
+        # and only need the count tables (not the trials)
+        # add on methods to do everything (other than qe) with full length
+        tasks = [(_CountSystem(self, full), qe_method, sampling, methods)]
+        tasks += [(_CountSystem(self, c), qe_method, sampling, [])
+                  for c in halves + quarters]
+        with stage('qe_eval'):
+            if executor is None:
+                results = map(_qe_eval, tasks)
+            else:
+                results = executor.map(_qe_eval, tasks)
+        H = [np.array([v for k,v in sorted(r['H'].iteritems())])
+             for r in results]
+        H1 = H[0]
+        H2 = (H[1] + H[2]) / 2.0
+        H4 = (H[3] + H[4] + H[5] + H[6]) / 4.0
+        N = full['N']
+        N2 = np.mean([c['N'] for c in halves])
+        N4 = np.mean([c['N'] for c in quarters])
+
+        # leave self with the full length sampling and entropies
+        self._sample(method=sampling, counts=full)
+        for k,v in results[0].iteritems():
+            setattr(self, k, v)
 
         # interpolation
         Hqe = np.zeros(H1.size)
         for i in xrange(H1.size):
             Hqe[i] = np.polyfit([N4,N2,N],
                         [N4*N4*H4[i], N2*N2*H2[i], N*N*H1[i]], 2)[0]
-        keys = [k for k,v in sorted(self.H_plugin.iteritems())]
+        keys = [k for k,v in sorted(self.H.iteritems())]
         self.H_qe = dict(zip(keys, Hqe))
 
 
+class _CountSystem(BaseSystem):
+    """System defined by a single set of count tables (for QE evaluation)"""
+
+    def __init__(self, sys, counts):
+        self.X_n = sys.X_n
+        self.X_m = sys.X_m
+        self.X_dim = sys.X_dim
+        self.Y_m = sys.Y_m
+        self.Y_dim = sys.Y_dim
+        self.calc = sys.calc
+        self.pix_block = getattr(sys, 'pix_block', _PIX_BLOCK)
+        self.counts = counts
+
+    def _count(self, part=None, n_parts=1):
+        return [self.counts]
+
+
+def _qe_eval(args):
+    """Evaluate entropies of a _CountSystem, returning the H dicts"""
+    sys, method, sampling, methods = args
+    sys._calc_ents(method, sampling, methods)
+    return dict([(k, getattr(sys, k)) for k in
+                 ('H', 'H_plugin', 'H_pt', 'H_nsb') if hasattr(sys, k)])
+
+
 class DiscreteSystem(BaseSystem):
     """Class to hold probabilities and calculate entropies of 
     a discrete stochastic system.
@@ -413,25 +618,57 @@ class DiscreteSystem(BaseSystem):
       PiX : (X_dim,)
         ``Pind(X) = <Pind(X|y)>_y``
 
+    In sparse mode the X_dim axis of PX, PXY is replaced by the observed 
+    words.
+
     """
 
-    def __init__(self, X, X_dims, Y, Y_dims, qe_shuffle=True):
+    def __init__(self, X, X_dims, Y, Y_dims, qe_shuffle=True, sparse=False,
+                 block=None, packed=False):
         """Check and assign inputs.
 
         :Parameters:
           X : (X_n, t)  int array
-            Array of measured input values. X_n variables in X space, t trials
+            Array of measured input values. X_n variables in X space, t trials.
+            May be a np.memmap or the path of a .npy file (which is memory
+            mapped).
           X_dims : tuple (n, m)
             Dimension of X (input) space; length n, base m words
           Y : (Y_n, t) int array
             Array of corresponding measured output values. Y_n variables in Y
-            space, t trials
+            space, t trials. May be a np.memmap or path of a .npy file.
           Y_dims : tuple (n ,m)
             Dimension of Y (output) space; length n, base m words
           qe_shuffle : {True, False}, optional
             Set to False if trials already in random order, to skip shuffling
             step in QE. Leave as True if trials have structure (ie one stimuli 
             after another).
+          sparse : {False, True}, optional
+            If True, X words are labelled by the distinct words observed 
+            rather than decimalised, and X probability tables only have rows
+            for the observed words (see Notes).
+          block : int, optional
+            Number of trials read at a time when checking and counting the
+            inputs (default 2**18).
+          packed : {False, True}, optional
+            If True, X is binary (X_m = 2) data bit-packed along the variable
+            axis, a (ceil(X_n/8), t) uint8 array as returned by 
+            ``pyentropy.codec.pack``. Words are read directly from the 
+            packed bytes.
+
+        Notes
+        -----
+        Use sparse mode when the X space (X_m ** X_n) is too large for dense
+        tables. The full space size is still used for the PT and NSB 
+        corrections. 'HiX' requires the full space and is not available in
+        sparse mode; 'ChiX' is evaluated at the observed words. Only naive
+        sampling is available, since the other sampling methods give 
+        probability to the unobserved words.
+
+        Inputs are validated, decimalised and histogrammed in blocks of
+        trials, so memory mapped recordings larger than memory can be used.
+        Shuffled entropies, QE and permutation tests also need a few integer
+        arrays of length t, and sparse mode reads all trials at once.
 
         """
         self.X_dims = X_dims
@@ -442,157 +679,385 @@ class DiscreteSystem(BaseSystem):
         self.Y_m = Y_dims[1]
         self.X_dim = self.X_m ** self.X_n
         self.Y_dim = self.Y_m ** self.Y_n
-        self.X = np.atleast_2d(X)
-        self.Y = np.atleast_2d(Y)
+        self.block = block or _BLOCK
+        self.packed = packed
+        self.X = np.atleast_2d(_load(X))
+        self.Y = np.atleast_2d(_load(Y))
         self._check_inputs(self.X, self.Y)
         self.N = self.X.shape[1]
         self.Ny = np.zeros(self.Y_dim)
         self.qe_shuffle = qe_shuffle
+        self.sparse = sparse
         self.sampled = False
         self.calc = []
         
-    def _sample(self, method='naive'):
-        """Sample probabilities of system.
+    def _count(self, part=None, n_parts=1):
+        """Histogram the trials into the count tables required by calc.
 
-        Parameters
-        ----------
-        method : {'naive', 'beta:x', 'kt'}, optional
-            Sampling method to use. 'naive' is the standard histrogram method.
-            'beta:x' is for an add-constant beta estimator, with beta value
-            following the colon eg 'beta:0.01' [1]_. 'kt' is for the 
-            Krichevsky-Trofimov estimator [2]_, which is equivalent to 
-            'beta:0.5'.
+        :Parameters:
+          part : (t,) int array, optional
+            Partition label of each trial in [0, n_parts]. Trials labelled
+            n_parts are discarded. If not given all trials are counted as a
+            single partition.
+          n_parts : int, optional
+            Number of partitions.
 
-        References
-        ----------
-        .. [1] T. Schurmann and P. Grassberger, "Entropy estimation of 
-           symbol sequences," Chaos,vol. 6, no. 3, pp. 414--427, 1996.
-        .. [2] R. Krichevsky and V. Trofimov, "The performance of universal 
-           encoding," IEEE Trans. Information Theory, vol. 27, no. 2, 
-           pp. 199--207, Mar. 1981. 
+        :Returns:
+          counts : list of dicts
+            Count tables for each partition, keyed by 'N', 'Ny', 'X', 'XY',
+            'Xi', 'XiY', 'shX', 'shXY' (only those required by calc).
+            Tables are plain histograms, so tables of disjoint partitions
+            can be added.
 
         """
+        N = self.X.shape[1]
+        if self.sparse or N <= self.block:
+            # all trials at once
+            return self._count_block(np.asarray(self.X), self._Y_labels(),
+                                     part, n_parts, True)
+        counts = None
+        for start in xrange(0, N, self.block):
+            sl = slice(start, start+self.block)
+            bpart = None if part is None else part[sl]
+            c = self._count_block(np.asarray(self.X[:,sl]), 
+                                  self._Y_labels(sl), bpart, n_parts, False)
+            if counts is None:
+                counts = c
+            else:
+                counts = [_addcounts(t) for t in zip(counts, c)]
+        with stage('shuffle'):
+            self._count_shuffled(counts, part, n_parts)
+        return counts
+
+    def _count_block(self, X, d_Y, part, n_parts, shuffle):
+        """Count tables (see _count) of a block of trials X with output 
+        labels d_Y. Shuffled tables are only counted if shuffle is True."""
         calc = self.calc
+        Y_dim = self.Y_dim
+        # labels are combined in np.intp (the input dtype may be too small)
+        d_Y = np.asarray(d_Y, dtype=np.intp)
+        if part is None:
+            # single partition, no discarded trials
+            n_slots = 1
+            g = d_Y
+        else:
+            # extra slot for the discarded trials
+            n_slots = n_parts + 1
+            g = d_Y + Y_dim*part
+        counts = [{} for p in xrange(n_slots)]
+
+        def _split(key, C):
+            for p in xrange(n_parts):
+                counts[p][key] = C[p]
+
+        Ny = np.bincount(g, minlength=Y_dim*n_slots).reshape((n_slots,Y_dim))
+        _split('Ny', Ny)
+        _split('N', Ny.sum(axis=1).astype(float))
+
+        def _joint(labels):
+            d_X, X_dim = labels
+            d_X = np.asarray(d_X, dtype=np.intp)
+            # X,Y joint count table of each partition from a single pass
+            # C[p,i,j] = number of trials in p with X==i, Y==j
+            C = np.bincount(d_X + X_dim*g, minlength=X_dim*Y_dim*n_slots)
+            return C.reshape((n_slots,Y_dim,X_dim)).transpose((0,2,1))
+
+        def _marginal(labels):
+            d_X, X_dim = labels
+            if part is not None:
+                d_X = np.asarray(d_X, dtype=np.intp) + X_dim*part
+            C = np.bincount(d_X, minlength=X_dim*n_slots)
+            return C.reshape((n_slots,X_dim))
+
+        with stage('histogram'):
+            # histogram
+            if any([c in calc for c in ['HXY','HXY1','ChiXY1']]):
+                CXY = _joint(self._X_labels(X))
+                _split('XY', CXY)
+                _split('X', CXY.sum(axis=2))
+            elif any([c in calc for c in ['HX','ChiX']]):
+                _split('X', _marginal(self._X_labels(X)))
+            if self.sparse and ('ChiX' in calc):
+                # digits of the observed words, in label order
+                words = self._unpack(unique_words(X)[0])
+                for p in xrange(n_parts):
+                    counts[p]['words'] = words
+            if any([c in calc for c in ['HiX','HiXY','ChiX']]):
+                CXiY = self._Xi_counts(self._unpack(X), g, Y_dim*n_slots)
+                CXiY = CXiY.reshape((self.X_m,self.X_n,n_slots,Y_dim))
+                for p in xrange(n_parts):
+                    counts[p]['XiY'] = CXiY[:,:,p,:]
+                    counts[p]['Xi'] = CXiY[:,:,p,:].sum(axis=2)
+            elif 'SiHXi' in calc:
+                CXi = self._Xi_counts(self._unpack(X), part, n_slots)
+                for p in xrange(n_parts):
+                    counts[p]['Xi'] = CXi[:,:,p]
+
+        # shuffled counts
+        if shuffle and (('HshXY' in calc) or ('HshX' in calc)):
+            X = self._unpack(X)
+            n_sh = getattr(self, 'n_shuffles', 1)
+            N = X.shape[1]
+            r = np.arange(n_sh)[:,np.newaxis]
+
+        def _shuffled(groups):
+            # labels (n_sh, t) of the words of n_sh shuffles of X, each 
+            # variable permuted within groups (one label space for all)
+            order, bounds = _group_bounds(groups)
+            Xsh = np.empty((self.X_n,n_sh*N), dtype=X.dtype)
+            for k in xrange(n_sh):
+                for j in xrange(self.X_n):
+                    sigma = _grouped_permutation(order, bounds)
+                    Xsh[j,k*N:(k+1)*N] = X[j,sigma]
+            d_X, n_X = self._X_labels(self._pack(Xsh))
+            return d_X.reshape((n_sh,N)), n_X
+
+        if shuffle and ('HshXY' in calc):
+            # shuffle each variable within output conditional ensembles
+            # (of each partition)
+            with stage('shuffle'):
+                d_X, n_X = _shuffled(g)
+            C = np.bincount((d_X + n_X*(g + Y_dim*n_slots*r)).ravel(),
+                            minlength=n_X*Y_dim*n_slots*n_sh)
+            # (n_slots, n_X, n_sh, Y_dim)
+            C = C.reshape((n_sh,n_slots,Y_dim,n_X)).transpose((1,3,0,2))
+            _split('shXY', np.ascontiguousarray(C))
+        if shuffle and ('HshX' in calc):
+            # unconditional shuffle (within each partition)
+            p = np.zeros(N, dtype=int) if part is None else part
+            with stage('shuffle'):
+                d_X, n_X = _shuffled(p)
+            C = np.bincount((d_X + n_X*(p + n_slots*r)).ravel(),
+                            minlength=n_X*n_slots*n_sh)
+            # (n_slots, n_X, n_sh)
+            C = C.reshape((n_sh,n_slots,n_X)).transpose((1,2,0))
+            _split('shX', np.ascontiguousarray(C))
+
+        return counts[:n_parts]
+
+    def _count_shuffled(self, counts, part, n_parts):
+        """Add shuffled count tables to counts when trials are read in 
+        blocks.
+
+        Each variable is permuted within its groups (output class and 
+        partition for HshXY, partition for HshX) over the whole recording.
+        Decimalised words are linear in the variables, so shuffled words 
+        are accumulated one variable at a time, reading the permuted values
+        in blocks. This needs a few integer arrays of the number of trials.
 
-        # decimalise
-        if any([c in calc for c in ['HXY','HX']]):
-            if self.X_n > 1:
-                d_X = decimalise(self.X, self.X_n, self.X_m)
-            else:
-                # make 1D
-                d_X = self.X.reshape(self.X.size)
-        if any([c in calc for c in ['HiX','HiXY','HXY','HY']]):
-            if self.Y_n > 1:
-                d_Y = decimalise(self.Y, self.Y_n, self.Y_m)
+        """
+        calc = self.calc
+        if not (('HshXY' in calc) or ('HshX' in calc)):
+            return
+        N = self.X.shape[1]
+        X_dim = self.X_dim
+        Y_dim = self.Y_dim
+        n_slots = 1 if part is None else n_parts + 1
+        # group label of every trial
+        g = np.empty(N, dtype=int)
+        for start in xrange(0, N, self.block):
+            sl = slice(start, start+self.block)
+            g[sl] = self._Y_labels(sl)
+            if part is not None:
+                g[sl] += Y_dim*part[sl]
+
+        n_sh = getattr(self, 'n_shuffles', 1)
+
+        def _words(groups):
+            # decimalised words with each variable permuted within groups
+            order, bounds = _group_bounds(groups)
+            d = np.zeros(N, dtype=int)
+            for j in xrange(self.X_n):
+                sigma = _grouped_permutation(order, bounds)
+                w = self.X_m ** (self.X_n - 1 - j)
+                for start in xrange(0, N, self.block):
+                    sl = slice(start, start+self.block)
+                    row = self._X_row(j, sigma[sl]).astype(np.intp)
+                    d[sl] += w * row
+            return d
+
+        if 'HshXY' in calc:
+            C = np.zeros((n_slots,X_dim,n_sh,Y_dim), dtype=int)
+            for k in xrange(n_sh):
+                d = _words(g)
+                Ck = np.bincount(d + X_dim*g, minlength=X_dim*Y_dim*n_slots)
+                C[:,:,k,:] = Ck.reshape((n_slots,Y_dim,X_dim)).transpose((0,2,1))
+            for p in xrange(n_parts):
+                counts[p]['shXY'] = C[p]
+        if 'HshX' in calc:
+            p = np.zeros(N, dtype=int) if part is None else part
+            C = np.zeros((n_slots,X_dim,n_sh), dtype=int)
+            for k in xrange(n_sh):
+                d = _words(p) + X_dim*p
+                Ck = np.bincount(d, minlength=X_dim*n_slots)
+                C[:,:,k] = Ck.reshape((n_slots,X_dim))
+            for p in xrange(n_parts):
+                counts[p]['shX'] = C[p]
+
+    def _X_labels(self, X):
+        """Integer (np.intp) labels of the X words of each trial and the 
+        number of labels. Decimalised words, or indices of the observed 
+        words if sparse."""
+        with stage('decimalise'):
+            if self.sparse:
+                # (packed words are compared byte-wise the same way)
+                words, labels = unique_words(X)
+                return labels.astype(np.intp, copy=False), words.shape[1]
+            # the input and encoded words may have a small integer dtype
+            if self.packed:
+                d = packed_words(X, self.X_n)
+            elif self.X_n > 1:
+                d = encode(X, self.X_m)
             else:
                 # make 1D
-                d_Y = self.Y.reshape(self.Y.size)
+                d = X.reshape(X.size)
+            return d.astype(np.intp, copy=False), self.X_dim
+
+    def _check_X(self, X):
+        if self.packed:
+            if (X.dtype != np.uint8) or (self.X_m != 2):
+                raise ValueError, "Packed X must be uint8 binary data"
+            if (X.shape[0] != (self.X_n + 7) // 8):
+                raise ValueError, "Packed X.shape[0] must equal ceil(X_n/8)"
+            return
+        if not _inrange(X, self.X_m, self.block):
+            raise ValueError, "X values must be in [0, X_m)"
+        if (X.shape[0] != self.X_n):
+            raise ValueError, "X.shape[0] must equal X_n"
 
-        # unconditional probabilities
-        if ('HX' in calc) or ('ChiX' in calc):
-            self.PX = prob(d_X, self.X_dim, method=method)
-            """test docstring fpr PX"""
-        if any([c in calc for c in ['HXY','HiX','HiXY','HY']]):
-            self.PY = prob(d_Y, self.Y_dim, method=method)
-        if 'SiHXi' in calc:
-            for i in xrange(self.X_n):
-                self.PXi[:,i] = prob(self.X[i,:], self.X_m, method=method)
-            
-        # conditional probabilities
-        if any([c in calc for c in ['HiXY','HXY','HshXY']]):
-            for i in xrange(self.Y_dim):
-                indx = np.where(d_Y==i)[0]
-                self.Ny[i] = indx.size
-                if 'HXY' in calc:
-                    # output conditional ensemble
-                    oce = d_X[indx]
-                    if oce.size == 0:
-                        print 'Warning: Null output conditional ensemble for ' + \
-                          'output : ' + str(i)
-                    else:
-                        self.PXY[:,i] = prob(oce, self.X_dim, method=method)
-                if any([c in calc for c in ['HiX','HiXY','HshXY']]):
-                    for j in xrange(self.X_n):
-                        # output conditional ensemble for a single variable
-                        oce = self.X[j,indx]
-                        if oce.size == 0:
-                            print 'Warning: Null independent output conditional ensemble for ' + \
-                                'output : ' + str(i) + ', variable : ' + str(j)
-                        else:
-                            self.PXiY[:,j,i] = prob(oce, self.X_m, method=method)
-                            if 'HshXY' in calc:
-                                # shuffle
-                                #np.random.shuffle(oce)
-                                shfoce = np.random.permutation(oce)
-                                self.Xsh[j,indx] = shfoce
-        # Pind(X) = <Pind(X|Y)>_y
-        if ('HiX' in calc) or ('ChiX' in calc):
-            # construct joint distribution
-            words = dec2base(np.atleast_2d(np.r_[0:self.X_dim]).T,self.X_m,self.X_n)
-            PiXY = np.zeros((self.X_dim, self.Y_dim))
-            PiXY = self.PXiY[words,np.r_[0:self.X_n]].prod(axis=1)
-            # average over Y
-            self.PiX = np.dot(PiXY,self.PY)
+    def _pack(self, X):
+        """Trials X in the stored format (packed or not)"""
+        return pack(X) if self.packed else X
+
+    def _unpack(self, X):
+        """(X_n, t) array of stored trials X"""
+        return unpack(X, self.X_n) if self.packed else X
+
+    def _X_row(self, j, indx):
+        """Values of variable j in trials indx"""
+        if self.packed:
+            bits = np.asarray(self.X[j//8,indx]) >> (7 - j%8)
+            return bits & 1
+        return np.asarray(self.X[j,indx])
+
+    def _Y_labels(self, sl=slice(None)):
+        """Decimalised Y words of each trial (in slice sl)"""
+        Y = np.asarray(self.Y[:,sl])
+        if self.Y_n > 1:
+            # (encode gives the smallest unsigned dtype)
+            return encode(Y, self.Y_m).astype(np.intp)
+        else:
+            # make 1D
+            return Y.reshape(Y.size)
 
-        self.sampled = True
+    def permutation_test(self, n_perm=1000, method='plugin', 
+                         sampling='naive', seed=None, chunk=100,
+                         executor=None):
+        """Permutation test of I(X;Y) against a null of shuffled Y labels.
+
+        Permuting the output labels leaves P(X) and P(Y) unchanged, so only
+        H(X|Y) is recomputed for the null. Joint count tables for a chunk 
+        of permutations are built with a single bincount and all their 
+        conditional entropies are evaluated together.
+
+        :Parameters:
+          n_perm : int, optional
+            Number of label permutations.
+          method : {'plugin', 'pt', 'nsb'}, optional
+            Bias correction method.
+          sampling : {'naive', 'beta:x', 'kt'}, optional
+            Sampling method (see ``calculate_entropies``).
+          seed : int, optional
+            Seed for the permutations. Each chunk uses its own RandomState
+            seeded from this, so results do not depend on executor.
+          chunk : int, optional
+            Number of permutations processed together.
+          executor : pool, optional
+            Object with a ``map`` method, eg a ``multiprocessing.Pool``,
+            over which the chunks are distributed.
+
+        :Returns:
+          I : float
+            Mutual information of the data.
+          Inull : (n_perm,) float array
+            Mutual information of each permutation.
+          p : float
+            Permutation p-value ``(1 + #(Inull >= I)) / (1 + n_perm)``.
+
+        """
+        if method not in ('plugin','pt','nsb'):
+            raise ValueError, 'Unknown correction method : '+str(method)
+        if (int(chunk) != chunk) or (chunk < 1):
+            raise ValueError, "chunk must be an integer of at least 1"
+        chunk = int(chunk)
+        if self.sparse and (sampling.lower() != 'naive'):
+            raise ValueError, "Only naive sampling is available in sparse mode"
+        if self.sparse:
+            d_X, n_X = self._X_labels(np.asarray(self.X))
+        else:
+            n_X = self.X_dim
+            d_X = np.concatenate([self._X_labels(
+                np.asarray(self.X[:,start:start+self.block]))[0] 
+                for start in xrange(0, self.X.shape[1], self.block)])
+        d_Y = self._Y_labels()
+        N = d_X.size
+        CX = np.bincount(d_X, minlength=n_X)
+        PX = _probcount(CX, N, sampling)
+        if method == 'nsb':
+            HX = nsb_entropy(PX, N, self.X_dim)[0] / np.log(2)
+        else:
+            HX = ent(PX)
+            if method == 'pt':
+                R = pt_bayescount(PX, N, self.X_dim)
+                HX += (R - 1) / (2*N*np.log(2))
+
+        args = (d_X, d_Y, n_X, self.X_dim, self.Y_dim, method, sampling)
+        I = HX - _perm_HXY(args + (None, 0))[0]
+
+        # independent RNG stream for each chunk
+        sizes = [chunk] * (n_perm // chunk)
+        if n_perm % chunk:
+            sizes.append(n_perm % chunk)
+        seeds = np.random.RandomState(seed).randint(2**31-1, size=len(sizes))
+        tasks = [args + (sd, sz) for sd, sz in zip(seeds, sizes)]
+        if executor is None:
+            results = map(_perm_HXY, tasks)
+        else:
+            results = executor.map(_perm_HXY, tasks)
+        Inull = HX - np.concatenate(list(results) + [np.zeros(0)])
+        p = (1 + (Inull >= I).sum()) / (1 + n_perm)
+        return I, Inull, p
 
     def _check_inputs(self, X, Y):
-        if (not np.issubdtype(X.dtype, np.int)) \
-        or (not np.issubdtype(Y.dtype, np.int)):
+        if (not np.issubdtype(X.dtype, np.integer)) \
+        or (not np.issubdtype(Y.dtype, np.integer)):
             raise ValueError, "Inputs must be of integer type"
-        if (X.max() >= self.X_m) or (X.min() < 0):
-            raise ValueError, "X values must be in [0, X_m)"
-        if (Y.max() >= self.Y_m) or (Y.min() < 0):
+        self._check_X(X)
+        if not _inrange(Y, self.Y_m, self.block):
             raise ValueError, "Y values must be in [0, Y_m)"        
-        if (X.shape[0] != self.X_n):
-            raise ValueError, "X.shape[0] must equal X_n"
         if (Y.shape[0] != self.Y_n):
             raise ValueError, "Y.shape[0] must equal Y_n"
         if (Y.shape[1] != X.shape[1]):
             raise ValueError, "X and Y must contain same number of trials"
 
-    def _sh_instance(self):
-        """Return shuffled instance"""
-        # do it like this to allow easy inheritence
-        return DiscreteSystem(self.Xsh, self.X_dims, self.Y, self.Y_dims)
-
-    def _shX_instance(self):
-        """Return shuffled instance"""
-        # do it like this to allow easy inheritence
-        # unconditional shuffle
-        Xsh_un = np.zeros_like(self.X)
-        for i in range(self.X_n):
-            shindx = np.random.permutation(self.X.shape[1])
-            Xsh_un[i,:] = self.X[i,shindx]
-        return DiscreteSystem(Xsh_un, self.X_dims, self.Y, self.Y_dims)
-
     def _qe_prep(self):
-        """QE Preparation"""
-        if self.qe_shuffle:
-            # need to shuffle to ensure even stimulus distribution for QE
-            shuffle = np.random.permutation(self.N)
-            self.X = self.X[:,shuffle]
-            self.Y = self.Y[:,shuffle]
-
-        # ensure trials is a multiple of 4 for easy QE
-        rem = np.mod(self.X.shape[1],4)
-        if rem != 0:
-            self.X = self.X[:,:-rem]
-            self.Y = self.Y[:,:-rem]
-        self.N = self.X.shape[1]
+        """QE Preparation
 
-    def _subsampled_instance(self, sub):
-        """Return subsampled instance for QE
-        
-        sub : tuple (df, i) 
-              red - reduction factor (2, 4)
-              i - interval
+        Returns the QE partition label (0-3) of each trial. Leftover trials
+        (to make the number of trials a multiple of 4) are labelled 4.
 
         """
-        Nred = self.N / sub[0]
-        sl = slice(sub[1]*Nred,(sub[1]+1)*Nred)
-        return DiscreteSystem(self.X[:,sl], self.X_dims,
-                              self.Y[:,sl], self.Y_dims)
+        N = self.X.shape[1]
+        N4 = N // 4
+        labels = np.repeat(np.arange(5), [N4, N4, N4, N4, N - 4*N4])
+        if self.qe_shuffle:
+            # need to shuffle to ensure even stimulus distribution for QE
+            shuffle = np.random.permutation(N)
+        else:
+            shuffle = np.arange(N)
+        part = np.empty(N, dtype=int)
+        part[shuffle] = labels
+        return part
 
 
 class SortedDiscreteSystem(DiscreteSystem):
@@ -618,12 +1083,14 @@ class SortedDiscreteSystem(DiscreteSystem):
         ``Pind(X) = <Pind(X|y)>_y``
 
     """
-    def __init__(self, X, X_dims, Y_m, Ny):
+    def __init__(self, X, X_dims, Y_m, Ny, sparse=False, block=None, 
+                 packed=False):
         """Check and assign inputs.
 
         :Parameters:
           X : (X_n, t) int array
-            Array of measured input values. X_n variables in X space, t trials
+            Array of measured input values. X_n variables in X space, t trials.
+            May be a np.memmap or the path of a .npy file.
           X_dims : tuple (n,m)
             Dimension of X (input) space; length n, base m words
           Y_m : int 
@@ -632,6 +1099,13 @@ class SortedDiscreteSystem(DiscreteSystem):
             Array of number of trials available for each stimulus. This should
             be ordered the same as the order of X w.r.t. stimuli. 
             Y_t.sum() = X.shape[1]
+          sparse : {False, True}, optional
+            Label X words by the distinct observed words (see 
+            ``DiscreteSystem``).
+          block : int, optional
+            Number of trials read at a time (see ``DiscreteSystem``).
+          packed : {False, True}, optional
+            X is bit-packed binary data (see ``DiscreteSystem``).
 
         """
         self.X_dims = X_dims
@@ -640,153 +1114,561 @@ class SortedDiscreteSystem(DiscreteSystem):
         self.Y_m = Y_m
         self.X_dim = self.X_m ** self.X_n
         self.Y_dim = self.Y_m 
-        self.X = np.atleast_2d(X)
+        self.block = block or _BLOCK
+        self.packed = packed
+        self.X = np.atleast_2d(_load(X))
         self.Ny = Ny.astype(float)
         self.N = self.X.shape[1]
         self._check_inputs()
+        # trials per stimulus of the data (self.Ny is reset by sampling)
+        self._Ny_data = self.Ny.astype(int)
         self.sampled = False
         self.qe_shuffle = True
+        self.sparse = sparse
         self.calc = []
 
     def _check_inputs(self):
-        if (not np.issubdtype(self.X.dtype, np.int)):
+        if (not np.issubdtype(self.X.dtype, np.integer)):
             raise ValueError, "Inputs must be of integer type"
-        if (self.X.max() >= self.X_m) or (self.X.min() < 0):
-            raise ValueError, "X values must be in [0, X_m)"
-        if (self.X.shape[0] != self.X_n):
-            raise ValueError, "X.shape[0] must equal X_n"
+        self._check_X(self.X)
         if (self.Ny.size != self.Y_m):
             raise ValueError, "Ny must contain Y_m elements"
         if (self.Ny.sum() != self.N):
             raise ValueError, "Ny.sum() must equal number of X input trials"
 
-    def _sample(self, method='naive'):
-        """Sample probabilities of system.
-
-        Parameters
-        ----------
+    def _Y_labels(self, sl=slice(None)):
+        """Output label of each trial (in slice sl)"""
+        t = np.arange(*sl.indices(self.X.shape[1]))
+        return np.searchsorted(self._Ny_data.cumsum(), t, side='right')
 
-        method : {'naive', 'beta:x', 'kt'}, optional
-            Sampling method to use. 'naive' is the standard histrogram method.
-            'beta:x' is for an add-constant beta estimator, with beta value
-            following the colon eg 'beta:0.01' [1]_. 'kt' is for the 
-            Krichevsky-Trofimov estimator [2]_, which is equivalent to 
-            'beta:0.5'.
+    def _qe_prep(self):
+        """QE Preparation
 
-        References
-        ----------
-        .. [1] T. Schurmann and P. Grassberger, "Entropy estimation of 
-           symbol sequences," Chaos,vol. 6, no. 3, pp. 414--427, 1996.
-        .. [2] R. Krichevsky and V. Trofimov, "The performance of universal 
-           encoding," IEEE Trans. Information Theory, vol. 27, no. 2, 
-           pp. 199--207, Mar. 1981. 
+        Returns the QE partition label of each trial. Each stimulus is split
+        into four partitions of ``floor(Ny/4)`` trials; leftover trials are
+        labelled 4.
 
         """
-        calc = self.calc
+        part = np.empty(self.X.shape[1], dtype=int)
+        sstart = 0
+        for i in xrange(self.Y_m):
+            n = self._Ny_data[i]
+            n4 = n // 4
+            labels = np.repeat(np.arange(5), [n4, n4, n4, n4, n - 4*n4])
+            if self.qe_shuffle:
+                # need to shuffle to ensure even stimulus distribution for QE
+                labels = labels[np.random.permutation(n)]
+            part[sstart:sstart+n] = labels
+            sstart += n
+        return part
 
-        # decimalise
-        if any([c in calc for c in ['HXY','HX']]):
-            if self.X_n > 1:
-                d_X = decimalise(self.X, self.X_n, self.X_m)
-            else:
-                # make 1D
-                d_X = self.X.reshape(self.X.size)
 
-        # unconditional probabilities
-        if ('HX' in calc) or ('ChiX' in calc):
-            self.PX = prob(d_X, self.X_dim, method=method)
-        if any([c in calc for c in ['HXY','HiX','HiXY','HY']]):
-            self.PY = _probcount(self.Ny,self.N,method)
-        if 'SiHXi' in calc:
-            for i in xrange(self.X_n):
-                self.PXi[:,i] = prob(self.X[i,:], self.X_m, method=method)
-            
-        # conditional probabilities
-        if any([c in calc for c in ['HiXY','HXY','HshXY']]):
-            sstart=0
-            for i in xrange(self.Y_dim):
-                send = sstart+self.Ny[i]
-                indx = slice(sstart,send)
-                sstart = send
-                if 'HXY' in calc:
-                    # output conditional ensemble
-                    oce = d_X[indx]
-                    if oce.size == 0:
-                        print 'Warning: Null output conditional ensemble for ' + \
-                          'output : ' + str(i)
-                    else:
-                        self.PXY[:,i] = prob(oce, self.X_dim, method=method)
-                if any([c in calc for c in ['HiX','HiXY','HshXY']]):
-                    for j in xrange(self.X_n):
-                        # output conditional ensemble for a single variable
-                        oce = self.X[j,indx]
-                        if oce.size == 0:
-                            print 'Warning: Null independent output conditional ensemble for ' + \
-                                'output : ' + str(i) + ', variable : ' + str(j)
-                        else:
-                            self.PXiY[:,j,i] = prob(oce, self.X_m, method=method)
-                            if 'HshXY' in calc:
-                                # shuffle
-                                #np.random.shuffle(oce)
-                                shfoce = np.random.permutation(oce)
-                                self.Xsh[j,indx] = shfoce
-        # Pind(X) = <Pind(X|Y)>_y
-        if ('HiX' in calc) or ('ChiX' in calc):
-            # construct joint distribution
-            words = dec2base(np.atleast_2d(np.r_[0:self.X_dim]).T,self.X_m,self.X_n)
-            PiXY = np.zeros((self.X_dim, self.Y_dim))
-            PiXY = self.PXiY[words,np.r_[0:self.X_n]].prod(axis=1)
-            # average over Y
-            self.PiX = np.dot(PiXY,self.PY)
+class StreamingDiscreteSystem(DiscreteSystem):
+    """Discrete system for trials which arrive in chunks.
 
-        self.sampled = True
+    Only the count tables needed for the requested entropies are kept, and 
+    each chunk of trials is added to them by ``update``. Entropies are 
+    evaluated from the current counts by ``calculate_entropies``.
+
+    """
 
-    def _sh_instance(self):
-        """Return shuffled instance"""
-        return SortedDiscreteSystem(self.Xsh, self.X_dims, self.Y_m, self.Ny)
+    def __init__(self, X_dims, Y_dims, calc=['HX','HXY']):
+        """Set up empty count tables.
 
-    def _shX_instance(self):
-        """Return shuffled instance"""
-        # unconditional shuffle
-        Xsh_un = np.zeros_like(self.X)
-        for i in range(self.X_n):
-            shindx = np.random.permutation(self.X.shape[1])
-            Xsh_un[i,:] = self.X[i,shindx]
-        return SortedDiscreteSystem(Xsh_un, self.X_dims, self.Y_m, self.Ny)
+        :Parameters:
+          X_dims : tuple (n, m)
+            Dimension of X (input) space; length n, base m words
+          Y_dims : tuple (n ,m)
+            Dimension of Y (output) space; length n, base m words
+          calc : list of strs, optional
+            Entropy values which will be calculated (see 
+            ``calculate_entropies``). The shuffled entropies 'HshX' and 
+            'HshXY' need all trials and are not available.
 
-    def _qe_prep(self):
-        """QE Preparation"""
-        if self.qe_shuffle:
-            # need to shuffle to ensure even stimulus distribution for QE
-            sstart = 0
-            for i in xrange(self.Y_m):
-                send = sstart + int(self.Ny[i])
-                shuffle = np.random.permutation(int(self.Ny[i]))
-                self.X[:,sstart:send] = self.X[:,sstart+shuffle]
-                sstart = send
-                
-    def _subsampled_instance(self, sub):
-        """Return subsampled instance for QE
-        
-        sub : tuple (df, i) 
-              red - reduction factor (2, 4)
-              i - interval
+        """
+        for c in ('HshX', 'HshXY'):
+            if c in calc:
+                raise ValueError, c + " is not available for streaming data"
+        self.X_dims = X_dims
+        self.Y_dims = Y_dims
+        self.X_n = X_dims[0]
+        self.X_m = X_dims[1]
+        self.Y_n = Y_dims[0]
+        self.Y_m = Y_dims[1]
+        self.X_dim = self.X_m ** self.X_n
+        self.Y_dim = self.Y_m ** self.Y_n
+        self.block = _BLOCK
+        self.packed = False
+        self.tracked = list(calc)
+        self.calc = self.tracked
+        self.counts = None
+        self.N = 0
+        self.Ny = np.zeros(self.Y_dim)
+        self.qe_shuffle = True
+        self.sparse = False
+        self.sampled = False
+
+    def update(self, X, Y):
+        """Add a chunk of trials to the count tables.
+
+        :Parameters:
+          X : (X_n, t) int array
+            Measured input values of the new trials
+          Y : (Y_n, t) int array
+            Corresponding output values
 
         """
+        X = np.atleast_2d(X)
+        Y = np.atleast_2d(Y)
+        self._check_inputs(X, Y)
+        self.X = X
+        self.Y = Y
+        self.calc = self.tracked
+        try:
+            counts = DiscreteSystem._count(self)[0]
+        finally:
+            # do not keep the trials
+            del self.X, self.Y
+        if self.counts is None:
+            self.counts = counts
+        else:
+            self.counts = _addcounts([self.counts, counts])
+        self.N = self.counts['N']
+        self._counts_kept = None
 
-        # reduce each Y data set 
-        slices = []
-        Ny_new = np.floor(self.Ny/sub[0]).astype(int)
-        sstart = 0
-        for i in xrange(self.Y_m):
-            send = sstart + int(self.Ny[i])
-            sl = slice(sstart + (sub[1] * Ny_new[i]), 
-                       sstart + ((sub[1]+1) * Ny_new[i]))
-            slices.append(sl)
-            sstart = send
-        X_new = self.X[:,np.r_[tuple(slices)]]
+    def calculate_entropies(self, method='plugin', sampling='naive',
+                            calc=None, **kwargs):
+        """Calculate entropies from the trials added so far.
+
+        Arguments are as for ``DiscreteSystem.calculate_entropies``, 
+        except that 'qe' is not available, and calc must be a subset of 
+        the entropies given to the constructor (the default).
+
+        """
+        if calc is None:
+            calc = self.tracked
+        for c in calc:
+            if c not in self.tracked:
+                raise ValueError, "Counts for " + c + " are not tracked"
+        if (method == 'qe') or ('qe' in kwargs.get('methods',[])):
+            raise ValueError, "QE is not available for streaming data"
+        if self.counts is None:
+            raise ValueError, "No trials have been added"
+        BaseSystem.calculate_entropies(self, method=method, 
+                                       sampling=sampling, calc=calc, 
+                                       **kwargs)
+
+    def _count(self, part=None, n_parts=1):
+        return [self.counts]
+
+
+def channel_information(X, X_dims, Y, Y_dims, methods=['plugin'], 
+                        sampling='naive', qe_shuffle=True):
+    """Mutual information I(X_c;Y) of many response channels X_c with a 
+    common output Y.
+
+    The joint X,Y count tables of all channels (and of the QE partitions) 
+    are histogrammed with a single bincount, and the entropies of all 
+    channels are evaluated together. This is much faster than creating a 
+    DiscreteSystem for each channel.
+
+    :Parameters:
+      X : (n_channels, t) or (n_channels, X_n, t) int array
+        Responses of each channel, t trials. The 2D form is for X_n = 1.
+      X_dims : tuple (n, m)
+        Dimension of the X space of each channel; length n, base m words
+      Y : (Y_n, t) int array
+        Array of corresponding measured output values.
+      Y_dims : tuple (n, m)
+        Dimension of Y (output) space; length n, base m words
+      methods : list of strs, optional
+        Corrections to compute from ('plugin', 'pt', 'qe', 'nsb')
+      sampling : {'naive', 'kt', 'beta:x'}, optional
+        Sampling method (see ``BaseSystem.calculate_entropies``)
+      qe_shuffle : {True, False}, optional
+        Set to False if trials already in random order, to skip shuffling
+        step in QE. The same QE partitions are used for all channels.
+
+    :Returns:
+      H : dict
+        For each method a dict of (n_channels,) float arrays keyed by
+        'HX', 'HXY' and 'I'.
+
+    """
+    for m in methods:
+        if m not in ('plugin','pt','qe','nsb'):
+            raise ValueError, 'Unknown correction method : '+str(m)
+    X_n, X_m = X_dims
+    Y_n, Y_m = Y_dims
+    X_dim = X_m ** X_n
+    Y_dim = Y_m ** Y_n
+    X = np.asarray(X)
+    Y = np.atleast_2d(Y)
+    _check_integer(X, Y)
+    if X.ndim == 2:
+        X = X[:,np.newaxis,:]
+    n_c, n, N = X.shape
+    if n != X_n:
+        raise ValueError, "X must have X_n variables per channel"
+    if Y.shape != (Y_n, N):
+        raise ValueError, "Y must be (Y_n, t) with the same trials as X"
+    if (X.max() >= X_m) or (X.min() < 0):
+        raise ValueError, "X values must be in [0, X_m)"
+    if (Y.max() >= Y_m) or (Y.min() < 0):
+        raise ValueError, "Y values must be in [0, Y_m)"
+
+    # decimalised words of every channel and trial
+    if X_n > 1:
+        d_X = encode(X.transpose((1,0,2)).reshape((X_n,-1)), X_m)
+        d_X = d_X.reshape((n_c,N)).astype(int)
+    else:
+        d_X = X[:,0,:].astype(int)
+    d_Y = encode(Y, Y_m).astype(int) if Y_n > 1 else Y[0].astype(int)
+
+    if 'qe' in methods:
+        # QE partition label of each trial (4 for leftover trials)
+        N4 = N // 4
+        labels = np.repeat(np.arange(5), [N4, N4, N4, N4, N - 4*N4])
+        part = np.empty(N, dtype=int)
+        if qe_shuffle:
+            part[np.random.permutation(N)] = labels
+        else:
+            part[:] = labels
+        n_slots = 5
+        g = d_Y + Y_dim*part
+    else:
+        n_slots = 1
+        g = d_Y
+    # C[c,p,j,i] = number of trials of partition p with X_c==i, Y==j
+    idx = d_X + X_dim*(g + (n_slots*Y_dim)*np.arange(n_c)[:,np.newaxis])
+    C = np.bincount(idx.ravel(), minlength=n_c*n_slots*Y_dim*X_dim)
+    C = C.reshape((n_c,n_slots,Y_dim,X_dim))
+    Ny = np.bincount(g, minlength=n_slots*Y_dim).reshape((n_slots,Y_dim))
+
+    def _ents(C, Ny, method):
+        # C (n_c, Y_dim, X_dim) -> HX, HXY of each channel
+        Ny = Ny.astype(float)
+        HX = _batch_HX(C.sum(axis=1).T, Ny.sum(), X_dim, method, sampling)
+        HXY = _batch_HXY(C.reshape((n_c*Y_dim,X_dim)).T, Ny, X_dim,
+                         method, sampling)
+        return HX, HXY
+
+    H = {}
+    # all trials
+    full = C.sum(axis=1)
+    for m in methods:
+        if m == 'qe':
+            continue
+        HX, HXY = _ents(full, Ny.sum(axis=0), m)
+        H[m] = {'HX': HX, 'HXY': HXY, 'I': HX - HXY}
+    if 'qe' in methods:
+        halves = [(C[:,p].sum(axis=1), Ny[p].sum(axis=0)) 
+                  for p in ([0,1], [2,3])]
+        quarters = [(C[:,p], Ny[p]) for p in xrange(4)]
+        H1 = _ents(C[:,:4].sum(axis=1), Ny[:4].sum(axis=0), 'plugin')
+        H2 = np.mean([_ents(c, ny, 'plugin') for c, ny in halves], axis=0)
+        H4 = np.mean([_ents(c, ny, 'plugin') for c, ny in quarters], axis=0)
+        Ns = np.array([N4, 2*N4, 4*N4], dtype=float)
+        # quadratic extrapolation of each entropy of each channel
+        Hs = np.array([H4, H2, H1]).reshape((3,-1))
+        Hqe = np.polyfit(Ns, Ns[:,np.newaxis]**2 * Hs, 2)[0]
+        HX, HXY = Hqe.reshape((2,n_c))
+        H['qe'] = {'HX': HX, 'HXY': HXY, 'I': HX - HXY}
+    return H
+
+
+def window_information(X, X_dims, Y, Y_dims, window, step=1, 
+                       methods=['plugin']):
+    """Time resolved mutual information I(X;Y) over a sliding window of 
+    trials.
+
+    The count tables are updated incrementally: at each position the 
+    incoming trials are added and the outgoing trials removed, and the 
+    plugin entropies are updated from the changed bins only, so each 
+    position costs O(step). The PT correction needs the Bayesian support 
+    estimate of the current tables, which is evaluated from the counts 
+    (without re-histogramming the window). Naive sampling is used.
+
+    :Parameters:
+      X : (X_n, t) int array
+        Array of measured input values. X_n variables in X space, t trials
+      X_dims : tuple (n, m)
+        Dimension of X (input) space; length n, base m words
+      Y : (Y_n, t) int array
+        Array of corresponding measured output values.
+      Y_dims : tuple (n, m)
+        Dimension of Y (output) space; length n, base m words
+      window : int
+        Number of trials in each window
+      step : int, optional
+        Number of trials the window moves between positions
+      methods : list of strs, optional
+        Corrections to compute from ('plugin', 'pt')
+
+    :Returns:
+      H : dict
+        For each method a dict of (n_windows,) float arrays keyed by 'HX',
+        'HXY' and 'I', where window k covers trials 
+        ``[k*step, k*step + window)``.
+
+    """
+    for m in methods:
+        if m not in ('plugin','pt'):
+            raise ValueError, 'Unknown correction method : '+str(m)
+    X_n, X_m = X_dims
+    Y_n, Y_m = Y_dims
+    X_dim = X_m ** X_n
+    Y_dim = Y_m ** Y_n
+    X = np.atleast_2d(X)
+    Y = np.atleast_2d(Y)
+    _check_integer(X, Y)
+    t = X.shape[1]
+    if (X.shape[0] != X_n) or (Y.shape != (Y_n, t)):
+        raise ValueError, "X must be (X_n, t) and Y (Y_n, t)"
+    if (X.max() >= X_m) or (X.min() < 0):
+        raise ValueError, "X values must be in [0, X_m)"
+    if (Y.max() >= Y_m) or (Y.min() < 0):
+        raise ValueError, "Y values must be in [0, Y_m)"
+    if (window < 1) or (step < 1) or (window > t):
+        raise ValueError, "Need 1 <= window <= t and step >= 1"
+    n_win = (t - window) // step + 1
+
+    d_X = encode(X, X_m).astype(int) if X_n > 1 else X[0].astype(int)
+    d_Y = encode(Y, Y_m).astype(int) if Y_n > 1 else Y[0].astype(int)
+    # bins of the X, Y and joint tables of each trial
+    bins = [d_X, d_Y, d_X + X_dim*d_Y]
+    dims = [X_dim, Y_dim, X_dim*Y_dim]
+    # c*log2(c) for every possible count
+    c = np.arange(window+1)
+    clogc = np.zeros(window+1)
+    clogc[1:] = c[1:] * np.log2(c[1:])
+
+    # count tables and sum(c*log2(c)) of each
+    C = [np.bincount(b[:window], minlength=d) for b, d in zip(bins, dims)]
+    S = np.array([clogc[Ci].sum() for Ci in C])
+    Ss = np.empty((n_win,3))
+    Ss[0] = S
+    pt = 'pt' in methods
+    if pt:
+        R = np.empty((n_win,Y_dim+1))
+        R[0] = _window_support(C[2], C[1], window, X_dim)
+    for k in xrange(1, n_win):
+        start = k*step
+        stop = start + window
+        if step < window:
+            out = slice(start - step, start)
+            inc = slice(stop - step, stop)
+        else:
+            # no overlap with the previous window
+            out = slice(start - step, start - step + window)
+            inc = slice(start, stop)
+        for i in xrange(3):
+            b = np.concatenate((bins[i][out], bins[i][inc]))
+            u = np.unique(b)
+            S[i] -= clogc[C[i][u]].sum()
+            np.subtract.at(C[i], bins[i][out], 1)
+            np.add.at(C[i], bins[i][inc], 1)
+            S[i] += clogc[C[i][u]].sum()
+        if (k % _RESYNC) == 0:
+            # avoid drift of the running sums
+            S = np.array([clogc[Ci].sum() for Ci in C])
+        Ss[k] = S
+        if pt:
+            R[k] = _window_support(C[2], C[1], window, X_dim)
+
+    N = float(window)
+    HX = np.log2(N) - Ss[:,0]/N
+    HXY = (Ss[:,1] - Ss[:,2])/N
+    H = {}
+    if 'plugin' in methods:
+        H['plugin'] = {'HX': HX, 'HXY': HXY, 'I': HX - HXY}
+    if pt:
+        pt_corr = (R - 1) / (2*N*np.log(2))
+        HXpt = HX + pt_corr[:,0]
+        HXYpt = HXY + pt_corr[:,1:].sum(axis=1)
+        H['pt'] = {'HX': HXpt, 'HXY': HXYpt, 'I': HXpt - HXYpt}
+    return H
+
+
+def _window_support(CXY, Ny, N, X_dim):
+    """PT Bayesian support estimates of P(X) and each P(X|y) from the flat
+    joint count table CXY (Y_dim*X_dim,) and output counts Ny"""
+    CXY = CXY.reshape((Ny.size,X_dim)).T
+    Ny = Ny.astype(float)
+    RX = pt_bayescount(CXY.sum(axis=1) / float(N), N, X_dim)
+    PXY = CXY / np.where(Ny == 0, 1, Ny)
+    RXY = pt_bayescount_batch(PXY, Ny, X_dim)
+    return np.concatenate(([RX], RXY))
+
+
+def _check_integer(*arrays):
+    """Raise ValueError unless all arrays are of integer type"""
+    for A in arrays:
+        if not np.issubdtype(A.dtype, np.integer):
+            raise ValueError, "Inputs must be of integer type"
 
-        return SortedDiscreteSystem(X_new, self.X_dims,
-                              self.Y_m, Ny_new)
 
+def _load(A):
+    """Memory map A if it is the path of a .npy file"""
+    if isinstance(A, basestring):
+        return np.load(A, mmap_mode='r')
+    return A
 
+
+def _inrange(A, m, block):
+    """Check all values of A (read in blocks of columns) are in [0, m)"""
+    for start in xrange(0, A.shape[1], block):
+        a = A[:,start:start+block]
+        if (a.max() >= m) or (a.min() < 0):
+            return False
+    return True
+
+
+def _pind(PXiY, PY, X_dim, block, idx=None, words=None, log=False):
+    """Pind(X) = sum_y P(y) prod_i P(x_i|y) for all X words.
+
+    The word space is processed in blocks of words, so neither the full
+    table of words nor Pind(X|Y) is formed. If idx is given Pind is only
+    evaluated for the words with those (decimalised) indices, or for the
+    columns idx of the (X_n, n) array of words if that is given. If log
+    is True log2 Pind(X) is returned, computed in log space so that it 
+    does not underflow for long words.
+
+    """
+    with stage('pix'):
+        if log:
+            with np.errstate(divide='ignore'):
+                PXiY = np.log2(PXiY)
+                PY = np.log2(PY)
+        X_m, X_n, Y_dim = PXiY.shape
+        n = X_dim if idx is None else idx.size
+        PiX = np.empty(n)
+        for start in xrange(0, n, block):
+            stop = min(start + block, n)
+            if idx is None:
+                w = decode(np.arange(start, stop), X_m, X_n)
+            elif words is None:
+                w = decode(idx[start:stop], X_m, X_n)
+            else:
+                w = words[:,idx[start:stop]]
+            PiX[start:stop] = _pind_words(PXiY, PY, w, log)
+        return PiX
+
+
+def _pind_words(PXiY, PY, words, log=False):
+    """Pind(X) for the columns of an (X_n, n) array of words (log2 Pind 
+    if log is True, with PXiY and PY given as log2 probabilities)"""
+    PiXY = PXiY[words[0],0]
+    if not log:
+        for i in xrange(1, words.shape[0]):
+            PiXY *= PXiY[words[i],i]
+        # average over Y
+        return np.dot(PiXY, PY)
+    for i in xrange(1, words.shape[0]):
+        PiXY += PXiY[words[i],i]
+    PiXY += PY
+    # log2 sum_y 2**PiXY, relative to the largest term
+    top = PiXY.max(axis=1)
+    top[~np.isfinite(top)] = 0
+    with np.errstate(divide='ignore'):
+        return top + np.log2(np.exp2(PiXY - top[:,np.newaxis]).sum(axis=1))
+
+
+def _group_bounds(groups):
+    """Stable argsort of the group labels of the trials, and the 
+    boundaries in it of the (non-empty) groups"""
+    order = np.argsort(groups, kind='mergesort')
+    g = groups[order]
+    bounds = np.r_[0, np.flatnonzero(g[1:] != g[:-1]) + 1, g.size]
+    return order, bounds
+
+
+def _grouped_permutation(order, bounds):
+    """Random permutation sigma of the trials within groups: trial k is 
+    replaced by trial sigma[k] of the same group. order and bounds are
+    from _group_bounds. Each group's slice of order is shuffled in place
+    (O(t) per permutation)."""
+    N = order.size
+    if bounds.size <= 2:
+        # single group
+        return np.random.permutation(N)
+    perm = order.copy()
+    for a, b in zip(bounds[:-1], bounds[1:]):
+        np.random.shuffle(perm[a:b])
+    sigma = np.empty(N, dtype=int)
+    sigma[order] = perm
+    return sigma
+
+
+def _addcounts(counts):
+    """Add count table dicts of disjoint sets of trials"""
+    total = {}
+    for k in counts[0]:
+        if k == 'words':
+            # observed words (sparse mode) are shared by all partitions
+            total[k] = counts[0][k]
+        else:
+            total[k] = sum([c[k] for c in counts])
+    return total
+
+
+def _perm_HXY(args):
+    """H(X|Y) for a batch of random permutations of the output labels.
+
+    args is (d_X, d_Y, n_X, X_dim, Y_dim, method, sampling, seed, n), where
+    d_X are labels in [0, n_X) and X_dim is the full size of the X space.
+    If seed is None the unpermuted labels are used.
+
+    """
+    d_X, d_Y, n_X, X_dim, Y_dim, method, sampling, seed, n = args
+    # labels are combined in np.intp (they may have a smaller dtype)
+    d_X = np.asarray(d_X, dtype=np.intp)
+    d_Y = np.asarray(d_Y, dtype=np.intp)
+    N = d_Y.size
+    if seed is None:
+        L = d_Y[np.newaxis,:]
+    else:
+        # random keys sorted along each row give independent permutations
+        rs = np.random.RandomState(seed)
+        L = d_Y[rs.random_sample((n,N)).argsort(axis=1)]
+    B = L.shape[0]
+    idx = d_X + n_X*L + (n_X*Y_dim)*np.arange(B)[:,np.newaxis]
+    C = np.bincount(idx.ravel(), minlength=n_X*Y_dim*B)
+    # (n_X, B*Y_dim) table of conditional counts
+    C = C.reshape((B*Y_dim,n_X)).T
+    Ny = np.bincount(d_Y, minlength=Y_dim).astype(float)
+    return _batch_HXY(C, Ny, X_dim, method, sampling)
+
+
+def _batch_HX(C, N, X_dim, method, sampling):
+    """H(X) for each column of an (n_X, B) table of counts of N trials"""
+    P = _probcount(C, N, sampling)
+    if method == 'nsb':
+        return nsb_entropy_batch(P, N, X_dim)[0] / np.log(2)
+    H = ent(P)
+    if method == 'pt':
+        R = pt_bayescount_batch(P, N, X_dim)
+        H += (R - 1) / (2*N*np.log(2))
+    return H
+
+
+def _batch_HXY(C, Ny, X_dim, method, sampling):
+    """H(X|Y) for B systems with the same output counts Ny (Y_dim,), from
+    an (n_X, B*Y_dim) table of conditional counts"""
+    Y_dim = Ny.size
+    B = C.shape[1] // Y_dim
+    N = Ny.sum()
+    PY = _probcount(Ny, N, sampling)
+    Nys = np.tile(Ny, B)
+    null = (Nys == 0)
+    P = _probcount(C, np.where(null, 1, Nys), sampling)
+    P[:,null] = 0
+    if method == 'nsb':
+        H = nsb_entropy_batch(P, Nys, X_dim)[0] / np.log(2)
+    else:
+        H = ent(P)
+    H = (H.reshape((B,Y_dim)) * PY).sum(axis=1)
+    if method == 'pt':
+        R = pt_bayescount_batch(P, Nys, X_dim)
+        H += ((R - 1) / (2*N*np.log(2))).reshape((B,Y_dim)).sum(axis=1)
+    return H
@@ -0,0 +1,65 @@
+#    This file is part of pyEntropy
+#
+#    pyEntropy is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 2 of the License, or
+#    (at your option) any later version.
+#
+#    pyEntropy is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with pyEntropy. If not, see <http://www.gnu.org/licenses/>.
+#
+#    Copyright 2009, 2010 Robin Ince
+
+import numpy as np
+from nose.tools import assert_raises
+from numpy.testing import *
+from pyentropy.codec import *
+from pyentropy import decimalise
+
+def test_word_dtype():
+    assert_equal(word_dtype(8, 2), np.uint8)
+    assert_equal(word_dtype(9, 2), np.uint16)
+    assert_equal(word_dtype(20, 3), np.uint32)
+    assert_equal(word_dtype(64, 2), np.uint64)
+    assert_raises(OverflowError, word_dtype, 65, 2)
+
+def test_roundtrip():
+    x = np.random.random_integers(0,4,(6,500))
+    d = encode(x, 5)
+    assert_equal(d.dtype, np.uint16)
+    assert_array_equal(d, decimalise(x, 6, 5))
+    assert_array_equal(decode(d, 5, 6), x)
+
+def test_uint8_input():
+    x = np.random.random_integers(0,1,(8,100)).astype(np.uint8)
+    d = encode(x, 2)
+    assert_equal(d.dtype, np.uint8)
+    assert_array_equal(decode(d, 2, 8), x)
+
+def test_exact_64bit():
+    # beyond float precision
+    x = np.ones((60,3), dtype=int)
+    x[-1,1] = 0
+    d = encode(x, 2)
+    assert_equal(int(d[0]), 2**60 - 1)
+    assert_equal(int(d[1]), 2**60 - 2)
+    assert_array_equal(decode(d, 2, 60), x)
+
+def test_encode_range():
+    assert_raises(ValueError, encode, np.array([[0,3]]), 3)
+    assert_raises(ValueError, encode, np.array([[0,-1]]), 3)
+
+def test_packed_words():
+    for n in [1, 5, 8, 12, 16, 30, 64]:
+        x = np.random.random_integers(0,1,(n,200))
+        p = pack(x)
+        assert_equal(p.shape, ((n+7)//8, 200))
+        assert_array_equal(unpack(p, n), x)
+        d = packed_words(p, n)
+        assert_equal(d.dtype, word_dtype(n, 2))
+        assert_array_equal(d, encode(x, 2))
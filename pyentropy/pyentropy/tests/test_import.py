@@ -0,0 +1,61 @@
+#    This file is part of pyEntropy
+#
+#    pyEntropy is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 2 of the License, or
+#    (at your option) any later version.
+#
+#    pyEntropy is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with pyEntropy. If not, see <http://www.gnu.org/licenses/>.
+#
+#    Copyright 2009, 2010 Robin Ince
+
+import os
+import sys
+import subprocess
+
+_SCRIPT = """
+import sys
+import numpy as np
+before = set(sys.modules)
+import pyentropy
+from pyentropy import DiscreteSystem
+x = np.random.random_integers(0,2,(3,200))
+y = np.random.random_integers(0,3,(1,200))
+s = DiscreteSystem(x,(3,3),y,(1,4))
+s.calculate_entropies(method='pt', calc=['HX','HXY','HiXY','HshXY'])
+used = set(sys.modules)
+import pyentropy.maxent
+imported = set(sys.modules)
+new = lambda mods: sorted([m for m in mods - before 
+                           if sys.modules[m] is not None])
+print repr((new(used), new(imported)))
+"""
+
+def _run():
+    # fresh interpreter, so modules loaded by other tests do not count
+    root = os.path.dirname(os.path.dirname(os.path.dirname(
+        os.path.abspath(__file__))))
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join([root, env.get('PYTHONPATH', '')])
+    p = subprocess.Popen([sys.executable, '-c', _SCRIPT], env=env, 
+                         stdout=subprocess.PIPE)
+    out = p.communicate()[0]
+    assert p.returncode == 0
+    return eval(out.strip().splitlines()[-1])
+
+def test_import():
+    used, imported = _run()
+    # no scipy, test framework or subprocess machinery for DiscreteSystem
+    for m in used:
+        assert m.split('.')[0] not in ('scipy', 'nose', 'subprocess', 
+                                       'tempfile'), m
+        assert 'testing' not in m, m
+    # importing maxent does not load scipy until it is used
+    for m in ['scipy.optimize', 'scipy.io', 'scipy.sparse']:
+        assert m not in imported, m
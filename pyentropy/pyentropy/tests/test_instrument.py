@@ -0,0 +1,74 @@
+#    This file is part of pyEntropy
+#
+#    pyEntropy is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 2 of the License, or
+#    (at your option) any later version.
+#
+#    pyEntropy is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with pyEntropy. If not, see <http://www.gnu.org/licenses/>.
+#
+#    Copyright 2009, 2010 Robin Ince
+
+from __future__ import with_statement
+import numpy as np
+from numpy.testing import *
+from pyentropy import DiscreteSystem, pt_bayescount_batch
+from pyentropy import instrument
+from pyentropy.instrument import Recorder, recording
+
+def test_recorder():
+    events = []
+    rec = Recorder(lambda *a: events.append(a))
+    with recording(rec):
+        instrument.count('a')
+        instrument.count('a', 2)
+        instrument.size('b', np.zeros(10))
+        with instrument.stage('c'):
+            pass
+    # disabled
+    instrument.count('a')
+    assert instrument._active is None
+    assert_equal(rec.counts, {'a': 3})
+    assert_equal(rec.sizes, {'b': 80})
+    assert_equal(rec.calls, {'c': 1})
+    assert_equal([e[:2] for e in events], 
+                 [('count','a'), ('count','a'), ('size','b'), ('time','c')])
+
+def test_pt_counters():
+    P = np.random.random((10,4))
+    P[5:] = 0
+    P /= P.sum(axis=0)
+    rec = Recorder()
+    with recording(rec):
+        pt_bayescount_batch(P, 20, 100)
+    assert_equal(rec.counts['pt_bayescount'], 1)
+    assert_equal(rec.counts['pt_columns'], 4)
+    assert rec.counts['pt_iterations'] > 0
+
+def test_system_stats():
+    x = np.random.random_integers(0,2,(3,500))
+    y = np.random.random_integers(0,3,(1,500))
+    calc = ['HX','HXY','HiXY','HshXY','SiHXi']
+    s = DiscreteSystem(x,(3,3),y,(1,4))
+    events = []
+    s.calculate_entropies(method='pt', calc=calc, methods=['nsb'],
+                          instrument=lambda *a: events.append(a))
+    for k in ['total','count','decimalise','histogram','shuffle',
+              'probabilities','pt','nsb']:
+        assert k in s.stats.timings, k
+    assert s.stats.timings['total'] >= s.stats.timings['count']
+    assert_equal(s.stats.sizes['XY'], s.PXY.nbytes)
+    assert s.stats.counts['pt_bayescount'] > 0
+    assert s.stats.counts['nsb_columns'] > 0
+    assert len(events) > 0
+    H = s.H.copy()
+    # results do not depend on instrumentation
+    s.calculate_entropies(method='pt', calc=calc, instrument=True)
+    assert_equal(s.H, H)
+    assert not s.stats.counts.has_key('nsb_columns')
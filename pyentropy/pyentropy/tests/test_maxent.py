@@ -58,5 +58,19 @@ def test_first_order_solve_loaded():
     p1d = order1direct(p, a_loaded)
     assert_array_almost_equal(p1a,p1d)
 
+def test_matrix():
+    # row r of A selects the words with alpha at pos
+    from pyentropy.maxent import _marginal_index
+    from pyentropy.codec import decode
+    A = a.A.toarray()
+    words = decode(np.arange(1, a.fdim), a.m, a.n).T
+    for order in xrange(1, a.n+1):
+        alpha, pos = _marginal_index(a.n, a.m, order)
+        start = a.order_idx[order-1]
+        assert_equal(start + alpha.shape[0], a.order_idx[order])
+        for r in xrange(alpha.shape[0]):
+            sel = (words[:,pos[r]] == alpha[r]).all(axis=1)
+            assert_array_equal(A[start+r], sel)
+
 if __name__ == '__main__':
     run_module_suite()
@@ -17,8 +17,10 @@
 
 import numpy as np
 from numpy.testing import *
-from nose.tools import with_setup
-from pyentropy import DiscreteSystem, SortedDiscreteSystem
+from nose.tools import with_setup, assert_raises
+from pyentropy import (DiscreteSystem, SortedDiscreteSystem, 
+                       StreamingDiscreteSystem, channel_information, 
+                       window_information, decimalise)
 
 # TODO: test ChiXY1 HXY1 for binary data (Adelman Ispike)
 # TODO: test running more than once on an instance (to catch eg shuffling bug)
@@ -166,6 +168,473 @@ def test_toy1_sorted():
     v = np.array([s.H[t] for t in toycalc])
     assert_array_almost_equal(v, toytrue)
 
+#
+# QE partition counts
+#
+
+def test_qe_counts():
+    x = np.random.random_integers(0,2,(3,400))
+    y = np.random.random_integers(0,3,(1,400))
+    s = DiscreteSystem(x,(3,3),y,(1,4))
+    s.calc = ['HXY','HiXY','HshXY']
+    full = s._count()[0]
+    quarters = s._count(s._qe_prep(), 4)
+    assert_equal([c['N'] for c in quarters], [100]*4)
+    for k in ['N', 'Ny', 'X', 'XY', 'Xi', 'XiY']:
+        assert_array_equal(sum([c[k] for c in quarters]), full[k])
+    # shuffling preserves the output conditional marginals
+    assert_array_equal(quarters[0]['shXY'][:,0].sum(axis=0), 
+                       quarters[0]['Ny'])
+
+def test_qe_executor():
+    from multiprocessing import Pool
+    from multiprocessing.pool import ThreadPool
+    x = np.random.random_integers(0,2,(3,400))
+    y = np.random.random_integers(0,3,(1,400))
+    calc = ['HX','HXY','HiXY','HshXY','HshX']
+    H = []
+    for executor in [None, ThreadPool(2), Pool(2)]:
+        np.random.seed(1)
+        s = DiscreteSystem(x,(3,3),y,(1,4))
+        s.calculate_entropies(method='qe', qe_method='pt', calc=calc,
+                              methods=['plugin'], executor=executor)
+        H.append([s.H[k] for k in calc] + [s.H_plugin[k] for k in calc])
+        if executor is not None:
+            executor.close()
+    assert_array_equal(H[0], H[1])
+    assert_array_equal(H[0], H[2])
+
+#
+# permutation test
+#
+
+def test_permutation_test():
+    x = np.random.random_integers(0,2,(2,300))
+    y = np.random.random_integers(0,2,(1,300))
+    for method in ['plugin', 'pt']:
+        s = DiscreteSystem(x,(2,3),y,(1,3))
+        s.calculate_entropies(method=method, calc=['HX','HXY'])
+        I, Inull, p = s.permutation_test(20, method=method, seed=0, chunk=8)
+        assert_almost_equal(I, s.I())
+        assert_equal(Inull.shape, (20,))
+        assert_almost_equal(p, (1 + (Inull >= I).sum()) / 21.0)
+        # first null value against an explicitly permuted system
+        rs = np.random.RandomState(np.random.RandomState(0).randint(2**31-1))
+        perm = rs.random_sample((8,300)).argsort(axis=1)[0]
+        s2 = DiscreteSystem(x,(2,3),y[:,perm],(1,3))
+        s2.calculate_entropies(method=method, calc=['HX','HXY'])
+        assert_almost_equal(Inull[0], s2.I())
+        # reproducible for a given seed
+        Inull2 = s.permutation_test(20, method=method, seed=0, chunk=8)[1]
+        assert_array_equal(Inull, Inull2)
+    for chunk in [0, -5, 2.5]:
+        assert_raises(ValueError, s.permutation_test, 20, chunk=chunk)
+
+def test_permutation_test_sorted():
+    x = np.random.random_integers(0,2,(2,300))
+    Ny = np.array([100,100,100])
+    s = SortedDiscreteSystem(x,(2,3),3,Ny)
+    s.calculate_entropies(method='plugin', calc=['HX','HXY'])
+    I, Inull, p = s.permutation_test(10, seed=0)
+    assert_almost_equal(I, s.I())
+    assert_equal(Inull.shape, (10,))
+
+#
+# sparse mode
+#
+
+def test_sparse():
+    x = np.random.random_integers(0,2,(3,500))
+    y = np.random.random_integers(0,3,(1,500))
+    calc = ['HX','HY','HXY','SiHXi','HiXY','HshXY','HshX']
+    for method in ['plugin', 'pt', 'qe']:
+        H = []
+        for sparse in [False, True]:
+            np.random.seed(0)
+            s = DiscreteSystem(x,(3,3),y,(1,4),sparse=sparse)
+            s.calculate_entropies(method=method, calc=calc)
+            H.append([s.H[k] for k in calc])
+        assert_array_almost_equal(H[0], H[1])
+    assert_raises(ValueError, s.calculate_entropies, calc=['HiX'])
+    # other sampling methods need the unobserved words
+    for sampling in ['kt', 'shrink', 'beta:0.1']:
+        assert_raises(ValueError, s.calculate_entropies, calc=calc, 
+                      sampling=sampling)
+        assert_raises(ValueError, s.permutation_test, n_perm=10,
+                      sampling=sampling)
+        s2 = DiscreteSystem(x,(3,3),y,(1,4))
+        s2.calculate_entropies(calc=calc, sampling=sampling)
+
+def test_chix_occupied():
+    x = np.random.random_integers(0,2,(5,300))
+    y = np.random.random_integers(0,1,(1,300))
+    s = DiscreteSystem(x,(5,3),y,(1,2))
+    s.calculate_entropies(calc=['HX','HiX','ChiX','HXY','ChiXY1'])
+    H = s.H.copy()
+    # ChiX from the full PiX
+    PiX = s.PiX.copy()
+    m = (s.PX > 0)
+    assert_almost_equal(H['ChiX'], -(s.PX[m]*np.log2(PiX[m])).sum())
+    # occupied words only (no full PiX)
+    for sparse in [False, True]:
+        s = DiscreteSystem(x,(5,3),y,(1,2),sparse=sparse)
+        s.calculate_entropies(calc=['HX','ChiX','HXY','ChiXY1'])
+        assert not hasattr(s, 'PiX')
+        for k in ['ChiX', 'ChiXY1']:
+            assert_almost_equal(s.H[k], H[k])
+
+def test_chix_long_words():
+    # Pind of 60 variable words is far below machine epsilon
+    x = np.random.random_integers(0,1,(60,500))
+    y = np.random.random_integers(0,2,(1,500))
+    s = DiscreteSystem(x,(60,2),y,(1,3),sparse=True)
+    s.calculate_entropies(calc=['HX','HXY','ChiX'])
+    # direct log space reference over the observed words
+    words, inv = np.unique(x.T.copy().view([('',x.dtype)]*60), 
+                           return_inverse=True)
+    PX = np.bincount(inv) / 500.0
+    logPY = np.log2(np.bincount(y[0], minlength=3) / 500.0)
+    L = np.empty(PX.size)
+    for k in xrange(PX.size):
+        w = x[:,np.flatnonzero(inv == k)[0]]
+        l = logPY.copy()
+        for j in xrange(3):
+            xj = x[:,y[0]==j]
+            l[j] += np.log2((xj == w[:,np.newaxis]).mean(axis=1)).sum()
+        L[k] = np.logaddexp2.reduce(l)
+    assert_almost_equal(s.H['ChiX'], -(PX*L).sum())
+    assert s.H['ChiX'] > 50
+
+def test_sparse_large():
+    # 2**40 word space
+    x = np.random.random_integers(0,1,(40,1000))
+    y = np.random.random_integers(0,1,(1,1000))
+    s = DiscreteSystem(x,(40,2),y,(1,2),sparse=True)
+    s.calculate_entropies(method='pt', calc=['HX','HXY'])
+    assert_equal(s.PX.size, np.unique(decimalise(x[:20],20,2) + 
+                 2**20*decimalise(x[20:],20,2)).size)
+    assert s.H_plugin['HX'] <= np.log2(1000) + 1e-10
+    assert s.H['HX'] > s.H_plugin['HX']
+    # 2**70 word space (X_dim does not fit in 64 bits)
+    x = np.random.random_integers(0,1,(70,1000))
+    for method in ['pt', 'nsb']:
+        s = DiscreteSystem(x,(70,2),y,(1,2),sparse=True)
+        s.calculate_entropies(method=method, calc=['HX','HXY'],
+                              methods=['plugin'])
+        for k in ['HX', 'HXY']:
+            assert np.isfinite(s.H[k])
+            assert s.H_plugin[k] < s.H[k] <= 70 + 1e-10
+
+def test_n_shuffles():
+    from pyentropy import dec2base
+    x = np.random.random_integers(0,2,(3,300))
+    y = np.random.random_integers(0,3,(1,300))
+    calc = ['HX','HXY','HiXY','HshXY','HshX','SiHXi']
+    s = DiscreteSystem(x,(3,3),y,(1,4))
+    s.calc = calc
+    s.n_shuffles = 5
+    c = s._count()[0]
+    assert_equal(c['shXY'].shape, (27,5,4))
+    assert_equal(c['shX'].shape, (27,5))
+    # every shuffle keeps the variable marginals (of each class)
+    words = dec2base(np.arange(27)[:,np.newaxis],3,3)
+    for k in range(5):
+        for j in range(3):
+            for i in range(3):
+                assert_array_equal(c['shXY'][words[:,j]==i,k].sum(axis=0),
+                                   c['XiY'][i,j])
+                assert_equal(c['shX'][words[:,j]==i,k].sum(), 
+                             c['Xi'][i,j])
+    # shuffled entropies are averages over the single shuffles
+    for method in ['plugin','pt','nsb']:
+        s._calc_ents(method, 'naive', [], c)
+        H = s.H.copy()
+        Hk = []
+        for k in range(5):
+            ck = dict(c)
+            ck['shXY'] = c['shXY'][:,k:k+1]
+            ck['shX'] = c['shX'][:,k:k+1]
+            s._calc_ents(method, 'naive', [], ck)
+            Hk.append([s.H['HshXY'], s.H['HshX']])
+        assert_array_almost_equal([H['HshXY'], H['HshX']], np.mean(Hk,0))
+    s.calculate_entropies(method='qe', calc=calc, n_shuffles=3)
+    assert_raises(ValueError, s.calculate_entropies, calc=calc, 
+                  n_shuffles=0)
+
+def test_kept_counts():
+    x = np.random.random_integers(0,2,(3,400))
+    y = np.random.random_integers(0,3,(1,400))
+    calc = ['HX','HXY','HiXY','HshXY']
+    s = DiscreteSystem(x,(3,3),y,(1,4))
+    n = [0]
+    count = s._count
+    def _count(*args):
+        n[0] += 1
+        return count(*args)
+    s._count = _count
+    s.calculate_entropies(method='pt', calc=calc)
+    Ish = s.Ish()
+    # other methods, sampling and a subset of calc reuse the counts
+    for method in ['plugin', 'pt', 'nsb']:
+        for sampling in ['naive', 'kt', 'beta:0.1']:
+            s.calculate_entropies(method=method, sampling=sampling, 
+                                  calc=calc[:2])
+            s2 = DiscreteSystem(x,(3,3),y,(1,4))
+            s2.calculate_entropies(method=method, sampling=sampling,
+                                   calc=calc[:2])
+            assert_almost_equal(s.I(), s2.I())
+    s.calculate_entropies(method='pt', calc=calc)
+    assert_almost_equal(s.Ish(), Ish)
+    assert_equal(n[0], 1)
+    # new tables, shuffles or explicit recount
+    s.calculate_entropies(calc=calc + ['SiHXi'])
+    assert_equal(n[0], 2)
+    s.calculate_entropies(calc=calc, n_shuffles=2)
+    assert_equal(n[0], 3)
+    s.calculate_entropies(calc=calc, n_shuffles=2, recount=True)
+    assert_equal(n[0], 4)
+    s.calculate_entropies(method='qe', calc=calc)
+    s.calculate_entropies(method='qe', qe_method='pt', calc=calc)
+    assert_equal(n[0], 5)
+
+#
+# channel batch
+#
+
+def test_channel_information():
+    x = np.random.random_integers(0,2,(5,2,401))
+    y = np.random.random_integers(0,3,(1,401))
+    methods = ['plugin','pt','qe','nsb']
+    np.random.seed(0)
+    H = channel_information(x,(2,3),y,(1,4),methods=methods)
+    for c in xrange(5):
+        for method in methods:
+            # same QE partition
+            np.random.seed(0)
+            s = DiscreteSystem(x[c],(2,3),y,(1,4))
+            s.calculate_entropies(method=method, calc=['HX','HXY'])
+            assert_almost_equal(H[method]['HX'][c], s.H['HX'])
+            assert_almost_equal(H[method]['HXY'][c], s.H['HXY'])
+            assert_almost_equal(H[method]['I'][c], s.I())
+    # 2D input for single variable channels
+    H = channel_information(x[:,0],(1,3),y,(1,4))
+    s = DiscreteSystem(x[3,0],(1,3),y,(1,4))
+    s.calculate_entropies(calc=['HX','HXY'])
+    assert_almost_equal(H['plugin']['I'][3], s.I())
+    assert_raises(ValueError, channel_information, x, (1,3), y, (1,4))
+    # float input is not truncated
+    assert_raises(ValueError, channel_information, x + 0.5, (2,3), y, (1,4))
+    assert_raises(ValueError, channel_information, x, (2,3), y*1.0, (1,4))
+
+def test_window_information():
+    x = np.random.random_integers(0,2,(2,1000))
+    y = np.random.random_integers(0,2,(1,1000))
+    for window, step in [(200,7), (100,150), (300,1)]:
+        H = window_information(x,(2,3),y,(1,3),window,step,['plugin','pt'])
+        n = (1000 - window) // step + 1
+        assert_equal(H['pt']['I'].size, n)
+        for k in [0, n//2, n-1]:
+            sl = slice(k*step, k*step+window)
+            for method in ['plugin','pt']:
+                s = DiscreteSystem(x[:,sl],(2,3),y[:,sl],(1,3))
+                s.calculate_entropies(method=method, calc=['HX','HXY'])
+                assert_almost_equal(H[method]['HX'][k], s.H['HX'])
+                assert_almost_equal(H[method]['HXY'][k], s.H['HXY'])
+                assert_almost_equal(H[method]['I'][k], s.I())
+    # float input is not truncated
+    assert_raises(ValueError, window_information, x + 0.5, (2,3), y, (1,3),
+                  100)
+    assert_raises(ValueError, window_information, x, (2,3), y*1.0, (1,3),
+                  100)
+
+#
+# streaming system
+#
+
+def test_streaming():
+    x = np.random.random_integers(0,2,(3,1000))
+    y = np.random.random_integers(0,3,(1,1000))
+    calc = ['HX','HY','HXY','SiHXi','HiX','HiXY','ChiX']
+    s = StreamingDiscreteSystem((3,3),(1,4),calc)
+    assert_raises(ValueError, s.calculate_entropies)
+    for i in range(0, 1000, 300):
+        s.update(x[:,i:i+300], y[:,i:i+300])
+    assert_equal(s.N, 1000)
+    # invalid chunks are rejected without changing the system
+    assert_raises(ValueError, s.update, x[:,:10], y[:,:10] + 4)
+    assert_raises(ValueError, s.update, x[:,:10] * 0.5, y[:,:10])
+    assert not hasattr(s, 'X')
+    assert_equal(s.N, 1000)
+    for method in ['plugin', 'pt']:
+        d = DiscreteSystem(x,(3,3),y,(1,4))
+        d.calculate_entropies(method=method, calc=calc)
+        s.calculate_entropies(method=method)
+        assert_array_almost_equal([s.H[k] for k in calc], 
+                                  [d.H[k] for k in calc])
+    assert_raises(ValueError, s.calculate_entropies, calc=['HshXY'])
+    assert_raises(ValueError, s.calculate_entropies, method='qe')
+
+#
+# block processing and memory mapped input
+#
+
+def test_blocks():
+    import os, shutil, tempfile
+    from pyentropy import dec2base
+    x = np.random.random_integers(0,2,(3,1000))
+    y = np.random.random_integers(0,3,(1,1000))
+    calc = ['HX','HY','HXY','SiHXi','HiX','HiXY','ChiX']
+    d = tempfile.mkdtemp()
+    try:
+        np.save(os.path.join(d,'x.npy'), x)
+        s = DiscreteSystem(os.path.join(d,'x.npy'),(3,3),y,(1,4),block=300)
+        assert isinstance(s.X, np.memmap)
+        for method in ['plugin', 'pt', 'qe']:
+            np.random.seed(0)
+            s.calculate_entropies(method=method, calc=calc)
+            np.random.seed(0)
+            s2 = DiscreteSystem(x,(3,3),y,(1,4))
+            s2.calculate_entropies(method=method, calc=calc)
+            assert_array_almost_equal([s.H[k] for k in calc],
+                                      [s2.H[k] for k in calc])
+        # blockwise shuffles keep the variable marginals of each class
+        s.calc = ['HiXY','HshXY']
+        s.n_shuffles = 2
+        c = s._count()[0]
+        words = dec2base(np.arange(27)[:,np.newaxis],3,3)
+        for j in range(3):
+            for i in range(3):
+                for k in range(2):
+                    assert_array_equal(
+                        c['shXY'][words[:,j]==i,k].sum(axis=0), 
+                        c['XiY'][i,j])
+        del s
+    finally:
+        shutil.rmtree(d)
+    # blockwise shuffled words of small integer input
+    x = np.random.random_integers(0,2,(5,1000))
+    calc = ['HX','HshX','HshXY']
+    H = []
+    for dt in [int, np.int8, np.uint8]:
+        np.random.seed(0)
+        s = DiscreteSystem(x.astype(dt),(5,3),y,(1,4),block=300)
+        s.calculate_entropies(calc=calc)
+        H.append([s.H[k] for k in calc])
+    assert_array_almost_equal(H[1], H[0])
+    assert_array_almost_equal(H[2], H[0])
+
+#
+# bit-packed binary input
+#
+
+def test_packed():
+    from pyentropy.codec import pack
+    x = np.random.random_integers(0,1,(10,2000))
+    y = np.random.random_integers(0,2,(1,2000))
+    calc = ['HX','HY','HXY','SiHXi','HiX','HiXY','ChiX','HshXY','HshX']
+    for kw in [{}, {'block':500}]:
+        np.random.seed(0)
+        s = DiscreteSystem(x,(10,2),y,(1,3),**kw)
+        s.calculate_entropies(method='pt', calc=calc)
+        np.random.seed(0)
+        sp = DiscreteSystem(pack(x),(10,2),y,(1,3),packed=True,**kw)
+        sp.calculate_entropies(method='pt', calc=calc)
+        assert_array_almost_equal([s.H[k] for k in calc], 
+                                  [sp.H[k] for k in calc])
+    assert_raises(ValueError, DiscreteSystem, x, (10,2), y, (1,3), 
+                  packed=True)
+
+def test_pix_block():
+    x = np.random.random_integers(0,2,(5,500))
+    y = np.random.random_integers(0,3,(1,500))
+    calc = ['HiX','ChiX']
+    s = DiscreteSystem(x,(5,3),y,(1,4))
+    s.calculate_entropies(calc=calc)
+    PiX = s.PiX.copy()
+    H = [s.H[k] for k in calc]
+    s.calculate_entropies(calc=calc, pix_block=7)
+    assert_array_almost_equal(s.PiX, PiX)
+    assert_array_almost_equal([s.H[k] for k in calc], H)
+    # direct product of marginals for one word
+    w = [2,0,1,1,0]
+    PiXw = (s.PXiY[w,range(5)].prod(axis=0) * s.PY).sum()
+    assert_almost_equal(s.PiX[decimalise(np.c_[w],5,3)[0]], PiXw)
+
+
+def test_multivariate_output():
+    # Y_n > 1: X_dim * Y_dim does not fit the dtype of the encoded words
+    x = np.random.random_integers(0,2,(3,2000))
+    y = np.random.random_integers(0,4,(2,2000))
+    dx = 9*x[0] + 3*x[1] + x[2]
+    dy = 5*y[0] + y[1]
+    # direct plugin estimates
+    def H(*labels):
+        w = np.zeros(2000, dtype=int)
+        for l in labels:
+            w = 100*w + l
+        p = np.unique(w, return_counts=True)[1] / 2000.0
+        return -(p*np.log2(p)).sum()
+    HX = H(dx)
+    HXY = H(dx, dy) - H(dy)
+    s = DiscreteSystem(x,(3,3),y,(2,5))
+    s.calculate_entropies(calc=['HX','HY','HXY','HiXY','ChiX'])
+    assert_almost_equal(s.H['HX'], HX)
+    assert_almost_equal(s.H['HY'], H(dy))
+    assert_almost_equal(s.H['HXY'], HXY)
+    # same as a single output variable with 25 values
+    s1 = DiscreteSystem(x,(3,3),dy,(1,25))
+    s1.calculate_entropies(calc=['HX','HY','HXY','HiXY','ChiX'])
+    for k in ['HiXY','ChiX']:
+        assert_almost_equal(s.H[k], s1.H[k])
+    I, Inull, p = s.permutation_test(n_perm=20)
+    assert_almost_equal(I, HX - HXY)
+    I1, Inull1, p1 = s1.permutation_test(n_perm=20, seed=1)
+    I, Inull, p = s.permutation_test(n_perm=20, seed=1)
+    assert_array_almost_equal(Inull, Inull1)
+
+#
+# small integer input types
+#
+
+def test_joint_labels():
+    # X,Y label arithmetic must not overflow small input dtypes
+    x = np.random.random_integers(0,9,(3,5000))
+    y = np.random.random_integers(0,39,(1,5000))
+    calc = ['HX','HY','HXY','SiHXi','HiXY']
+    s = DiscreteSystem(x,(3,10),y,(1,40))
+    s.calculate_entropies(calc=calc)
+    for dt in [np.int8, np.int16]:
+        s2 = DiscreteSystem(x.astype(dt),(3,10),y.astype(dt),(1,40))
+        s2.calculate_entropies(calc=calc)
+        assert_array_almost_equal([s2.H[k] for k in calc], 
+                                  [s.H[k] for k in calc])
+
+def test_input_dtypes():
+    # all integer input types give the same results as int64
+    x = np.random.random_integers(0,2,(3,1000))
+    y = np.random.random_integers(0,19,(1,1000))
+    calc = ['HX','HY','HXY','SiHXi','HiX','HiXY','HshX','HshXY','ChiX']
+    H = {}
+    for dt in [np.int64, np.uint8, np.int8, np.int16]:
+        for method in ['pt', 'qe']:
+            np.random.seed(0)
+            s = DiscreteSystem(x.astype(dt),(3,3),y.astype(dt),(1,20))
+            s.calculate_entropies(method=method, calc=calc)
+            H[dt, method] = [s.H[k] for k in calc]
+        H[dt, 'perm'] = s.permutation_test(n_perm=10, seed=0)[1]
+        order = np.argsort(y[0], kind='mergesort')
+        Ny = np.bincount(y[0], minlength=20)
+        s = SortedDiscreteSystem(x[:,order].astype(dt),(3,3),20,Ny)
+        s.calculate_entropies(method='pt', calc=calc)
+        H[dt, 'sorted'] = [s.H[k] for k in calc]
+        s = DiscreteSystem(x.astype(dt),(3,3),y.astype(dt),(1,20),
+                           sparse=True)
+        s.calculate_entropies(method='pt', calc=['HX','HXY','ChiX'])
+        H[dt, 'sparse'] = [s.H[k] for k in ['HX','HXY','ChiX']]
+    for dt in [np.uint8, np.int8, np.int16]:
+        for k in ['pt', 'qe', 'perm', 'sorted', 'sparse']:
+            assert_array_almost_equal(H[dt, k], H[np.int64, k])
+
     
 if __name__ == '__main__':
     run_module_suite()
@@ -18,6 +18,7 @@ import numpy as np
 from nose.tools import assert_raises
 from numpy.testing import *
 from pyentropy.utils import *
+from pyentropy import utils
 
 def setup():
     global x, x2, y, a1, b1, a2, b2
@@ -85,6 +86,35 @@ def test_prob_naive():
 def test_prob_naive_missed_responses():
     assert_equal(prob(a2,10), b2)
     
+def test_probcount_columns():
+    # each column of a count table sampled as a separate distribution
+    C = np.c_[np.bincount(a1, minlength=10), np.bincount(a2, minlength=10)]
+    for method in ['naive', 'kt', 'beta:0.1', 'shrink']:
+        P = utils._probcount(C, C.sum(axis=0), method)
+        assert_array_almost_equal(P[:,0], prob(a1, 10, method))
+        assert_array_almost_equal(P[:,1], prob(a2, 10, method))
+
+def test_ent():
+    P = np.random.random((8,3,4))
+    P[2:5] = 0
+    P[:,1,2] = 0
+    P /= np.where(P.sum(axis=0) > 0, P.sum(axis=0), 1)
+    L = np.zeros_like(P)
+    L[P > 0] = np.log2(P[P > 0])
+    H = -(P*L).sum(axis=0)
+    assert_array_almost_equal(ent(P), H)
+    assert_equal(ent(P)[1,2], 0)
+    assert_almost_equal(ent(P[:,0,0]), H[0,0])
+    # other axes, output buffer, single precision
+    assert_array_almost_equal(ent(np.rollaxis(P, 0, 3), axis=2), H)
+    assert_almost_equal(ent(P, axis=None), -(P*L).sum())
+    out = np.empty((3,4))
+    assert ent(P, out=out) is out
+    assert_array_almost_equal(out, H)
+    H32 = ent(P, dtype=np.float32)
+    assert_equal(H32.dtype, np.float32)
+    assert_array_almost_equal(H32, H, 5)
+
 def test_pt_bayescount():
     # values match original bayescount.m file
     for n,r in [(100000, 5.0), (50, 5.0), (30, 6.0),
@@ -93,6 +123,95 @@ def test_pt_bayescount():
         
 def check_pt_bayes(n, r):
     assert_equal(pt_bayescount(b1,n),r)
+
+def pt_bayescount_incremental(Pr, Nt):
+    """Original incremental support search (reference for pt_bayescount)"""
+    dim = Pr.size
+    PrNZ = Pr[Pr>np.finfo(np.float).eps]
+    Rnaive = PrNZ.size
+    if Rnaive < dim:
+        Rexpected = Rnaive - ((1.0-PrNZ)**Nt).sum()
+        deltaR_prev = dim
+        deltaR = np.abs(Rnaive - Rexpected)
+        xtr = 0.0
+        while (deltaR < deltaR_prev) and ((Rnaive+xtr)<dim):
+            xtr = xtr+1.0
+            gamma = xtr*(1.0 - ((Nt/(Nt+Rnaive))**(1.0/Nt)))
+            Pbayes = ((1.0-gamma) / (Nt+Rnaive)) * (PrNZ*Nt+1.0)
+            Rexpected = (1.0 - (1.0-Pbayes)**Nt).sum()
+            Pbayes = gamma / xtr
+            Rexpected = Rexpected + xtr*(1.0 - (1.0 - Pbayes)**Nt)
+            deltaR_prev = deltaR
+            deltaR = np.abs(Rnaive - Rexpected)
+        Rnaive = Rnaive + xtr - 1.0
+        if deltaR < deltaR_prev:
+            Rnaive += 1.0
+    return Rnaive
+
+def test_pt_bayescount_regression():
+    # bisection search must match the original incremental search
+    rs = np.random.RandomState(0)
+    olderr = np.seterr(all='ignore')
+    try:
+        for i in range(500):
+            dim = rs.choice([2, 5, 10, 64, 300, 2048])
+            N = float(rs.choice([1, 3, 10, 30, 100, 1000]))
+            p = rs.dirichlet(np.ones(dim)*rs.choice([0.01, 0.1, 1, 5]))
+            P = rs.multinomial(int(N), p) / N
+            assert_equal(pt_bayescount(P, N), pt_bayescount_incremental(P, N))
+    finally:
+        np.seterr(**olderr)
+
+def test_pt_bayescount_dim():
+    # occupied bins only, with the full dimension given
+    rs = np.random.RandomState(1)
+    olderr = np.seterr(all='ignore')
+    try:
+        for i in range(50):
+            P = rs.multinomial(100, rs.dirichlet(np.ones(5000)*0.1)) / 100.0
+            assert_equal(pt_bayescount(P[P>0], 100, 5000), 
+                         pt_bayescount(P, 100))
+    finally:
+        np.seterr(**olderr)
+
+def test_unique_words():
+    x = np.random.random_integers(0,2,(5,200))
+    words, labels = unique_words(x)
+    assert_array_equal(words[:,labels], x)
+    assert_equal(words.shape[1], np.unique(decimalise(x,5,3)).size)
+
+def test_pt_bayescount_batch():
+    P = np.c_[b1, b2, b1]
+    N = np.array([30, 12, 7])
+    assert_equal(pt_bayescount_batch(P, N), 
+                 [pt_bayescount(P[:,i], N[i]) for i in range(3)])
     
+def test_nsb_no_data():
+    # with no data the posterior is the prior, uniform in H on [0, log(K)]
+    H, dH = nsb_entropy(np.zeros(10), 0, 10)
+    assert_almost_equal(H, np.log(10)/2.0)
+
+def test_nsb_entropy():
+    # checked against direct adaptive quadrature of the NSB integral
+    c = np.array([5, 3, 0, 0, 1, 0, 2, 7])
+    H, dH = nsb_entropy(c/18.0, 18, 8)
+    assert_almost_equal(H, 1.58618802443, decimal=8)
+
+def test_nsb_large_sample():
+    # well sampled so NSB should agree with plugin estimate
+    p = np.array([0.5, 0.25, 0.125, 0.125])
+    H, dH = nsb_entropy(p, 800000, 4)
+    assert_almost_equal(H, 1.75*np.log(2), decimal=4)
+    assert_(dH < 1e-3)
+
+def test_nsb_batch():
+    # batch estimates must match single distribution estimates
+    P = np.c_[b1, b2, np.zeros(10)]
+    N = np.array([10, 10, 0])
+    H, dH = nsb_entropy_batch(P, N, np.array([10, 16, 10]))
+    for i, dim in enumerate([10, 16, 10]):
+        assert_array_almost_equal([H[i], dH[i]], 
+                                  nsb_entropy(P[:,i], N[i], dim))
+
 if __name__ == '__main__':
     run_module_suite()
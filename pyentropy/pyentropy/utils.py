@@ -19,19 +19,59 @@ distributions. These functions are exposed in the top-level pyentropy
 namespace.
 
 """
-from __future__ import division
+from __future__ import division, with_statement
 import numpy as np
-from tempfile import NamedTemporaryFile
-import os
-import subprocess
-from numpy.ma.core import _MaskedUnaryOperation, _DomainGreater
-import numpy.core.umath as umath
+import codec
+import instrument
 
-malog2 = _MaskedUnaryOperation(umath.log2, 1.0, _DomainGreater(0.0))
+def ent(p, axis=0, out=None, dtype=None):
+    """Entropy (bits) of probability distributions.
 
-def ent(p):
-    mp = np.ma.array(p,copy=False,mask=(p<=np.finfo(np.float).eps))
-    return -(mp*malog2(mp)).sum(axis=0)
+    Bins with p <= eps contribute nothing, so zero (or numerically zero) 
+    probabilities are safe. Only plain ndarray operations are used, with 
+    a single temporary of the size of p.
+
+    :Parameters:
+      p : array
+        Probabilities. Each slice along axis is a distribution, so a 2D 
+        table gives the entropy of each column with the default axis.
+      axis : int or None, optional
+        Axis of the distributions (default 0). None treats all of p as a 
+        single distribution.
+      out : array, optional
+        Array to hold the result (the shape of p without axis).
+      dtype : dtype, optional
+        Floating point type of the calculation, eg ``np.float32`` to 
+        halve the temporary memory for large tables.
+
+    :Returns:
+      H : float or array
+        Entropy of each distribution
+
+    """
+    return _xlog2(p, p, axis, out, dtype, np.finfo(np.float).eps)
+
+
+def _cross_ent(p, q, axis=0, out=None, dtype=None):
+    """Cross entropy -sum(p*log2(q)) (bits) over the bins with q > 0"""
+    return _xlog2(p, q, axis, out, dtype, 0.0)
+
+
+def _xlog2(p, q, axis, out, dtype, floor):
+    """-sum(p*log2(q)) along axis, excluding bins with q <= floor"""
+    if dtype is None:
+        dtype = np.result_type(q, 1.0)
+    q = np.asarray(q, dtype=dtype)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        L = np.log2(q)
+    L[~(q > floor)] = 0
+    L *= p
+    H = L.sum(axis=axis, out=out)
+    # (0 - H rather than -H, so empty distributions give +0)
+    if out is None:
+        return 0.0 - H
+    np.subtract(0.0, out, out)
+    return out
 
 
 def prob(x, m, method='naive'):
@@ -67,59 +107,54 @@ def _probcount(C, N, method='naive'):
     
     :Parameters:
       C : int array
-        integer vector of bin counts
-      N : int
-        number of trials
+        integer vector of bin counts. If C has more than one dimension 
+        each slice along the first axis (ie each column of a 2D table) is 
+        treated as a separate distribution.
+      N : int or array
+        number of trials (for each column of C)
       method: {'naive', 'kt', 'beta:x','shrink'}
         Sampling method to use. 
 
     """
-    N = float(N)
+    N = np.asarray(N, dtype=float)
+    dim = C.shape[0]
     if method.lower() == 'naive':
         # normal estimate
         P = C/N
     elif method.lower() == 'kt':
         # KT (constant addition) estimate
-        P = (C + 0.5) / (N + (C.size/2.0))
+        P = (C + 0.5) / (N + (dim/2.0))
     elif method.lower() == 'shrink':
         # James-Stein shrinkage
         # http://www.strimmerlab.org/software/entropy/index.html
         Pnaive = C/N
-        target = 1./C.size
+        target = 1./dim
         lam = _get_lambda_shrink(N, Pnaive, target)
         P = (lam * target) + ((1 - lam) * Pnaive)
     elif method.split(':')[0].lower() == 'beta':
         beta = float(method.split(':')[1])
         # general add-constant beta estimate
-        P = (C + beta) / (N + (beta*C.size))
+        P = (C + beta) / (N + (beta*dim))
     else:
-        raise ValueError, 'Unknown sampling method: '+str(est)
+        raise ValueError, 'Unknown sampling method: '+str(method)
     return P
 
 
 def _get_lambda_shrink(N, u, target):
-    """Lambda shrinkage estimator"""
+    """Lambda shrinkage estimator (for each column of u)"""
     # *unbiased* estimator of variance of u
     varu = u*(1-u)/(N-1)
     # misspecification
-    msp = ((u-target)**2).sum()
+    msp = ((u-target)**2).sum(axis=0)
 
     # estimate shrinkage intensity
-    if msp == 0:
-        lam = 1.
-    else:
-        lam = (varu/msp).sum()
+    lam = np.where(msp == 0, 1., varu.sum(axis=0) / np.where(msp == 0, 1., msp))
         
     # truncate
-    if lam > 1:
-        lam = 1 
-    elif lam < 0:
-        lam = 0
+    return np.clip(lam, 0, 1)
 
-    return lam
 
-
-def pt_bayescount(Pr, Nt):
+def pt_bayescount(Pr, Nt, dim=None):
     """Compute the support for analytic bias correction using the 
     Bayesian approach of Panzeri and Treves (1996)
     
@@ -128,6 +163,9 @@ def pt_bayescount(Pr, Nt):
         Probability vector
       Nt : int
         Number of trials
+      dim : int, optional
+        Full dimension of space, if Pr only covers some of the bins (eg
+        the occupied ones). Defaults to Pr.size.
 
     :Returns:
       R : int
@@ -135,42 +173,164 @@ def pt_bayescount(Pr, Nt):
     
     """
     
-    # dimension of space
-    dim = Pr.size
+    # dimension of space (as float: very large spaces are Python longs)
+    if dim is None:
+        dim = Pr.size
+    dim = float(dim)
 
+    instrument.count('pt_bayescount')
+    instrument.count('pt_columns')
     # non zero probs only
     PrNZ = Pr[Pr>np.finfo(np.float).eps]
     Rnaive = PrNZ.size
     
-    R = Rnaive
-    if Rnaive < dim:
-        Rexpected = Rnaive - ((1.0-PrNZ)**Nt).sum()
-        deltaR_prev = dim
-        deltaR = np.abs(Rnaive - Rexpected)
-        xtr = 0.0
-        while (deltaR < deltaR_prev) and ((Rnaive+xtr)<dim):
-            xtr = xtr+1.0
-            Rexpected = 0.0
+    if Rnaive < dim and Nt > 0:
+        return _pt_search(PrNZ[:,np.newaxis], None, 
+                          np.array([Rnaive], dtype=float),
+                          np.array([Nt], dtype=float), dim)[0]
+    return Rnaive
+
+
+def pt_bayescount_batch(Pr, Nt, dim=None):
+    """Compute the Bayesian support estimates of Panzeri and Treves (1996)
+    for each column of a probability table.
+
+    The result is the same as calling :func:`pt_bayescount` on each column, 
+    but the search is performed for all columns together.
+    
+    :Parameters:
+      Pr : (dim, K) array
+        Probability vectors (columns)
+      Nt : int or (K,) array
+        Number of trials for each column
+      dim : int, optional
+        Full dimension of space (>= number of rows of Pr)
+
+    :Returns:
+      R : (K,) float array
+        Bayesian estimates of support
+    
+    """
+    K = Pr.shape[1]
+    instrument.count('pt_bayescount')
+    instrument.count('pt_columns', K)
+    if dim is None:
+        dim = Pr.shape[0]
+    # (as float: very large spaces are Python longs)
+    dim = np.asarray(dim, dtype=float)
+    Nt = np.zeros(K) + Nt
+
+    # non zero probs only
+    NZ = Pr > np.finfo(np.float).eps
+    R = NZ.sum(axis=0).astype(float)
+
+    act = np.flatnonzero((R < dim) & (Nt > 0))
+    if act.size:
+        NZ = NZ[:,act]
+        R[act] = _pt_search(np.where(NZ, Pr[:,act], 0.0), NZ, R[act], 
+                            Nt[act], dim)
+    return R
+
+
+def _pt_search(P, NZ, R, N, dim):
+    """Bayesian support search for columns of P (occupied bins NZ, or all
+    rows if NZ is None) with R occupied bins and N trials.
+
+    The original procedure adds extra bins one at a time and stops at the
+    first local minimum of d(x) = abs(R - Rexpected(x)). Rexpected is 
+    concave in the number of extra bins x, so f(x) = R - Rexpected(x) is 
+    convex and the same minimum is located by bisection on the sign of f 
+    and of its increments, needing O(log(dim)) evaluations per column.
+
+    """
+    def f(x, i):
+        # R - Rexpected with x extra bins, for columns i
+        Nt = N[i]
+        Rn = R[i]
+        # gamma > 1 for many extra bins; powers may overflow there
+        with np.errstate(over='ignore', invalid='ignore'):
             # occupied bins
-            gamma = xtr*(1.0 - ((Nt/(Nt+Rnaive))**(1.0/Nt)))
-            Pbayes = ((1.0-gamma) / (Nt+Rnaive)) * (PrNZ*Nt+1.0)
-            Rexpected = (1.0 - (1.0-Pbayes)**Nt).sum()
+            gamma = x*(1.0 - ((Nt/(Nt+Rn))**(1.0/Nt)))
+            Pbayes = ((1.0-gamma) / (Nt+Rn)) * (P[:,i]*Nt+1.0)
+            if NZ is None:
+                Rexpected = (1.0 - (1.0-Pbayes)**Nt).sum(axis=0)
+            else:
+                Rexpected = np.where(NZ[:,i], 1.0 - (1.0-Pbayes)**Nt, 
+                                     0.0).sum(axis=0)
             # non-occupied bins
-            Pbayes = gamma / xtr
-            Rexpected = Rexpected + xtr*(1.0 - (1.0 - Pbayes)**Nt)
-            deltaR_prev = deltaR
-            deltaR = np.abs(Rnaive - Rexpected)
-        Rnaive = Rnaive + xtr - 1.0
-        if deltaR < deltaR_prev:
-            Rnaive += 1.0
-    return Rnaive
+            Pbayes = gamma / x
+            Rexpected = Rexpected + x*(1.0 - (1.0 - Pbayes)**Nt)
+        return Rn - Rexpected
+
+    def stops(x, i):
+        # search stops at x if d(x+1) >= d(x)
+        return np.abs(f(x+1.0, i)) >= np.abs(f(x, i))
+
+    def first(pred, lo, hi, i):
+        # first x in [lo, hi) with pred(x, i) (monotone), or hi if none
+        lo = lo.copy()
+        hi = hi.copy()
+        while True:
+            s = np.flatnonzero(lo < hi)
+            if s.size == 0:
+                return lo
+            instrument.count('pt_iterations')
+            mid = np.floor((lo[s] + hi[s]) / 2.0)
+            p = pred(mid, i[s])
+            hi[s] = np.where(p, mid, hi[s])
+            lo[s] = np.where(p, lo[s], mid+1.0)
+
+    K = R.size
+    cap = dim - R
+    xs = np.zeros(K) + cap
+    allc = np.arange(K)
+    one = np.ones(K)
+    # no extra bins (initial estimate uses naive probabilities)
+    if NZ is None:
+        d0 = ((1.0-P)**N).sum(axis=0)
+    else:
+        d0 = np.where(NZ, (1.0-P)**N, 0.0).sum(axis=0)
+    done = np.abs(f(one, allc)) >= d0
+    xs[done] = 0.0
+    i = np.flatnonzero(~done & (cap > 1))
+    if i.size:
+        # f decreasing on [1, xm), non-decreasing after
+        xm = first(lambda x, i: f(x+1.0, i) >= f(x, i), one[i], cap[i], i)
+        # first crossing below zero while decreasing
+        xc = first(lambda x, i: f(x+1.0, i) < 0, one[i], xm, i)
+        ans = np.zeros(i.size) + cap[i]
+        start = xm.copy()
+        # crossing: stops there, or one later if still decreasing
+        c = xc < xm
+        if c.any():
+            st = stops(xc[c], i[c])
+            more = ~st & (xc[c]+1.0 < xm[c])
+            ans[c] = np.where(st, xc[c], np.where(more, xc[c]+1.0, ans[c]))
+            start[c] = np.where(st | more, cap[i[c]], xm[c])
+        # non-decreasing region from start
+        c = start < cap[i]
+        if c.any():
+            sc = start[c]
+            ic = i[c]
+            st = (f(sc, ic) >= 0) | stops(sc, ic)
+            # f < 0 and increasing: first crossing to non-negative
+            xp = first(lambda x, i: f(x+1.0, i) >= 0, sc, cap[ic], ic)
+            xp_st = np.zeros(sc.size, dtype=bool)
+            o = xp < cap[ic]
+            if o.any():
+                xp_st[o] = stops(xp[o], ic[o])
+            ans[c] = np.where(st, sc, np.where(xp_st, xp, xp + 1.0))
+        xs[i] = np.minimum(ans, cap[i])
+    return R + xs
 
 
 def nsb_entropy(P, N, dim):
-    """Calculate NSB entropy of a probability distribution using
-    external nsb-entropy program.
+    """Calculate NSB entropy of a probability distribution.
 
-    Required `nsb-entropy` installed on system path.
+    The Nemenman-Shafee-Bialek estimate is the posterior mean of the 
+    entropy under a mixture of symmetric Dirichlet priors chosen to be 
+    uniform in the expected entropy [1]_. The integral over the mixture is 
+    evaluated numerically from the bin counts. Requires SciPy.
 
     :Parameters:
       P : 1D array
@@ -179,41 +339,182 @@ def nsb_entropy(P, N, dim):
         Total number of trials
       dim : int 
         Full dimension of space
+
+    :Returns:
+      [H, dH] : list
+        NSB entropy estimate and its posterior standard deviation (nats)
+
+    References
+    ----------
+    .. [1] I. Nemenman, F. Shafee and W. Bialek, "Entropy and inference, 
+       revisited," Advances in Neural Information Processing Systems 14, 
+       2002.
     
     """
-    
-    freqs = np.round(P*N)
-    tf = NamedTemporaryFile(mode='w',suffix='.txt')
+    H, dH = nsb_entropy_batch(np.atleast_2d(P).T, N, dim)
+    return [H[0], dH[0]]
+
+
+def nsb_entropy_batch(P, N, dim):
+    """Calculate NSB entropies of many probability distributions together.
+
+    Each column is estimated as with :func:`nsb_entropy`, but the count 
+    histograms and quadrature tables are shared between all the columns.
+    Requires SciPy.
+
+    :Parameters:
+      P : (R, K) array
+        Probability distribution vectors (columns)
+      N : int or (K,) array
+        Number of trials for each column
+      dim : int or (K,) array
+        Full dimension of space for each column (>= R)
+
+    :Returns:
+      H, dH : (K,) arrays
+        NSB entropy estimates and posterior standard deviations (nats)
 
-    # write file header
-    tf.file.write("# type: scalar\n")
-    tf.file.write(str(dim) + "\n")
-    tf.file.write("# rows: 1\n")
-    tf.file.write("# columns: " + str(freqs.sum().astype(int)) + "\n")
+    """
+    C = np.round(P*N).astype(int)
+    instrument.count('nsb_columns', C.shape[1])
+    return _nsb_counts(C, dim)
 
-    # write data
-    for i in xrange(freqs.size):
-        tf.file.write(freqs[i]*(str(i)+" "))
-    tf.file.write("\n")
-    tf.file.close()
 
-    # run nsb-entropy application
-    subprocess.call(["nsb-entropy","-dpar","-iuni","-cY","-s1","-e1",tf.name[:-4]], 
-                    stdout=open(os.devnull),stderr=open(os.devnull))
+# number of quadrature nodes in each pass of the NSB integration
+_NSB_GRID = 100
+# maximum number of refinements of the grid around the posterior peak
+_NSB_REFINE = 8
+# log-posterior range (nats) below the peak kept when refining
+_NSB_LOGTOL = 30.0
+# maximum size of temporary (nodes, count values, columns) arrays
+_NSB_BLOCK = 2**21
 
-    # read results
-    dir, fname = os.path.split(tf.name)
-    out_fname = os.path.splitext(fname)[0]+"_uni_num"+str(dim)+"_mf1f0_1_entr.txt"
-    out_fname = os.path.join(dir,out_fname)
-    fd = open(out_fname,mode='r')
-    results = fd.readlines()
-    fd.close()
-    os.remove(out_fname)
+def _nsb_counts(C, dim):
+    """NSB entropies H, dH (nats) of the columns of a count table.
 
-    H = float(results[15].split(' ')[0])
-    dH = float(results[20].split(' ')[0])
+    The posterior is integrated by Gauss-Legendre quadrature in xi (the
+    prior expected entropy), over a range which is repeatedly narrowed 
+    around the region where the posterior is non-negligible. Columns are
+    described by their histogram of counts over the count values present 
+    anywhere in C, so the digamma tables are shared between columns.
 
-    return [H, dH]
+    """
+    C = np.asarray(C)
+    K = C.shape[1]
+    # (as float: very large spaces are Python longs)
+    dim = np.zeros(K) + np.asarray(dim, dtype=float)
+    H = np.zeros(K)
+    dH = np.zeros(K)
+    # histogram of counts: M[u,k] bins of column k contain vals[u] trials
+    vals, inv = np.unique(C, return_inverse=True)
+    U = vals.size
+    M = np.bincount(inv + U*np.tile(np.arange(K), C.shape[0]),
+                    minlength=U*K).reshape((K,U)).T.astype(float)
+    if vals[0] != 0:
+        vals = np.r_[0, vals]
+        M = np.r_[np.zeros((1,K)), M]
+    # empty bins, including those outside the rows of C
+    M[0] = dim - M[1:].sum(axis=0)
+    vals = vals.astype(float)
+    N = np.dot(vals, M)
+
+    todo = np.flatnonzero(dim > 1)
+    bs = max(_NSB_BLOCK // (_NSB_GRID*vals.size), 1)
+    for i in xrange(0, todo.size, bs):
+        cols = todo[i:i+bs]
+        H[cols], dH[cols] = _nsb_block(vals, M[:,cols], N[cols], dim[cols])
+    return H, dH
+
+
+def _nsb_block(vals, M, N, K):
+    """NSB integration for a block of columns described by count 
+    histograms M (vals.size, k)"""
+    from scipy.special import gammaln, psi, polygamma
+
+    occ = vals > 0
+    nv = vals[:,np.newaxis,np.newaxis]
+
+    def logrho(beta, M, N, K):
+        # log evidence P(n|beta) (up to a constant), beta (nodes, k)
+        L = gammaln(K*beta) - gammaln(N + K*beta)
+        if occ.any():
+            L += (M[occ,np.newaxis]*(gammaln(nv[occ]+beta) - 
+                                     gammaln(beta))).sum(axis=0)
+        return L
+
+    def moments(beta, M, N, K):
+        # first and second moments of H given beta
+        M = M[:,np.newaxis]
+        A = N + K*beta
+        a = nv + beta
+        S1 = psi(A+1) - (M*a*psi(a+1)).sum(axis=0) / A
+        p0 = psi(A+2)
+        p1 = polygamma(1, A+2)
+        f = a*(psi(a+1) - p0)
+        cross = ((M*f).sum(axis=0)**2 - (M*f*f).sum(axis=0) - 
+                 p1*(A*A - (M*a*a).sum(axis=0)))
+        diag = (M*a*(a+1)*((psi(a+2) - p0)**2 + polygamma(1, a+2) - 
+                p1)).sum(axis=0)
+        S2 = (cross + diag) / (A*(A+1))
+        return S1, S2
+
+    x, wx = np.polynomial.legendre.leggauss(_NSB_GRID)
+    x = (x[:,np.newaxis] + 1) / 2.0
+    wx = wx[:,np.newaxis]
+    H = np.zeros(K.size)
+    dH = np.zeros(K.size)
+    lo = np.zeros(K.size)
+    hi = np.log(K)
+    act = np.arange(K.size)
+    for it in xrange(_NSB_REFINE):
+        xi = lo[act] + (hi[act] - lo[act])*x
+        if it == 0:
+            # first pass nodes only depend on the dimension
+            Ku, Kinv = np.unique(K, return_inverse=True)
+            beta = _nsb_beta(x*np.log(Ku), Ku)[:,Kinv]
+        else:
+            beta = _nsb_beta(xi, K[act])
+        L = logrho(beta, M[:,act], N[act], K[act])
+        L -= L.max(axis=0)
+        keep = L >= -_NSB_LOGTOL
+        nkeep = keep.sum(axis=0)
+        done = (nkeep >= _NSB_GRID/4) | (it == _NSB_REFINE-1)
+        if done.any():
+            c = act[done]
+            w = wx*np.exp(L[:,done])
+            w /= w.sum(axis=0)
+            S1, S2 = moments(beta[:,done], M[:,c], N[c], K[c])
+            H[c] = (w*S1).sum(axis=0)
+            dH[c] = np.sqrt(np.maximum((w*S2).sum(axis=0) - H[c]**2, 0.0))
+        # narrow the range to the nodes around the peak
+        keep = keep[:,~done]
+        xi = xi[:,~done]
+        act = act[~done]
+        if act.size == 0:
+            break
+        cols = np.arange(act.size)
+        first = keep.argmax(axis=0)
+        last = _NSB_GRID - 1 - keep[::-1].argmax(axis=0)
+        lo[act] = np.where(first > 0, xi[np.maximum(first-1, 0),cols], lo[act])
+        hi[act] = np.where(last < _NSB_GRID-1, 
+                           xi[np.minimum(last+1, _NSB_GRID-1),cols], hi[act])
+    return H, dH
+
+
+def _nsb_beta(xi, K):
+    """Invert xi(beta) = psi(K*beta+1) - psi(beta+1) by bisection on
+    log(beta)"""
+    from scipy.special import psi
+
+    lo = np.zeros(xi.shape) - 60.0
+    hi = np.zeros(xi.shape) + 30.0
+    for i in xrange(64):
+        mid = (lo + hi) / 2.0
+        b = np.exp(mid)
+        under = (psi(K*b+1) - psi(b+1)) < xi
+        lo = np.where(under, mid, lo)
+        hi = np.where(under, hi, mid)
+    return np.exp((lo + hi) / 2.0)
 
 
 def dec2base(x, b, digits):
@@ -241,10 +542,7 @@ def dec2base(x, b, digits):
     if xs[1] != 1:
         raise ValueError, "Input x must be a 1D array or column vector!"
 
-    power = np.ones((xs[0],1)) * (b ** np.c_[digits-1:-0.5:-1,].T)
-    x = np.tile(x,(1,digits))
-    y = np.floor( np.remainder(x, b*power) / power )
-    return y.astype(int)
+    return codec.decode(x, b, digits).T.astype(int)
 
 def base2dec(x, b):
     """Convert base-b words to decimal values.
@@ -263,10 +561,31 @@ def base2dec(x, b):
     differently (here x[t,n] - ie columns are trials).
     
     """
-    xs = x.shape
-    z = b**np.arange((xs[1]-1),-0.5,-1)
-    d_x = np.dot(x, z)
-    return d_x.astype(int)
+    return codec.encode(np.asarray(x).T, b).astype(int)
+
+
+def unique_words(x):
+    """Find the distinct words (columns) of an integer array.
+
+    Words are compared as raw bytes, so no decimalisation is done and the
+    size of the word space does not matter.
+
+    :Parameters:
+      x : (n, t) int array
+        Array of t words of length n
+
+    :Returns:
+      words : (n, U) int array
+        The U distinct words
+      labels : (t,) int array
+        Index of each word of x in words, ``x == words[:,labels]``
+
+    """
+    x = np.atleast_2d(x)
+    xt = np.ascontiguousarray(x.T)
+    v = xt.view(np.dtype((np.void, xt.dtype.itemsize*xt.shape[1]))).ravel()
+    u, idx, labels = np.unique(v, return_index=True, return_inverse=True)
+    return x[:,idx], labels
 
 
 def decimalise(x, n, b):
@@ -285,9 +604,7 @@ def decimalise(x, n, b):
     """
     if x.shape[0] != n or x.max() > b-1:
         raise ValueError, "Input vector x doesnt match parameters"
-    powers = b**np.arange(n-1,-0.5,-1)
-    d_x = np.dot(x.T,powers).astype(int)
-    return d_x
+    return codec.encode(x, b).astype(int)
 
 
 def quantise(input, m, uniform='sampling', minmax=None,